@@ -19,6 +19,9 @@ setup(
         'python-Levenshtein==0.12.0',
         'click>=2.0',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+import os
+
+from typo.correctors import TypoDefault
+from typo.correctors.utils import WordTuple
+
+
+def write_index(path, words, **options):
+    """ Convert (word, hits) pairs to an index at path, see convert """
+    with open(path, 'w+b') as fd:
+        TypoDefault.convert((WordTuple(word, None, hits, None)
+                             for word, hits in words),
+                            fd, tmp_dir=os.path.dirname(path), **options)
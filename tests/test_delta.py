@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+from typo.cli import cli
+from typo.correctors import TypoDefault
+from typo.correctors.default import posting_keys
+
+from helpers import write_index
+
+WORDS = [(u'night', 300), (u'street', 200), (u'lamp', 100), (u'lane', 50)]
+DELTA = [(u'lantern', 1000), (u'lamp', 150), (u'street', None)]
+UPDATED = [(u'night', 300), (u'lamp', 150), (u'lane', 50), (u'lantern', 1000)]
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'test.index')
+        write_index(self.path, WORDS)
+        TypoDefault.add_delta(self.path, DELTA)
+        self.corrector = TypoDefault(self.path, lang='en')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_overlays(self):
+        c = self.corrector
+        self.assertEqual(len(c.index.delta), 3)
+        # words
+        self.assertEqual(c.weights[u'lantern'], 1000)
+        self.assertEqual(c.weights[u'lamp'], 150)
+        self.assertNotIn(u'street', c.good_words)
+        # postings
+        for name, keys in posting_keys(u'lantern').items():
+            for key in keys:
+                self.assertIn((u'lantern', 1000), getattr(c, name)[key])
+        for name, keys in posting_keys(u'street').items():
+            for key in keys:
+                self.assertNotIn(u'street', [word for word, _
+                                             in getattr(c, name).get(key, ())])
+        self.assertIn((u'lamp', 150), c.deletes[u'lmp'])
+        # corpus
+        self.assertEqual([word for _, word, _ in c.corpus.bucket(ord(u'l'), 7)],
+                         [u'lantern'])
+        self.assertEqual(c.corpus.bucket(ord(u's'), 6), [])
+        # trie
+        self.assertEqual([(end, c.words.word(i)) for end, i
+                          in c.trie.prefixes(u'lanternnight')],
+                         [(7, u'lantern')])
+        self.assertEqual(c.trie.prefixes(u'street'), [])
+        self.assertEqual(c.find_candidates(u'lanterm')[0][0], u'lantern')
+
+    def test_compact_is_a_new_build(self):
+        compacted = os.path.join(self.tmp_dir, 'compacted.index')
+        built = os.path.join(self.tmp_dir, 'built.index')
+        with open(compacted, 'w+b') as fd:
+            TypoDefault.compact(self.path, fd, tmp_dir=self.tmp_dir)
+        write_index(built, UPDATED)
+        with open(compacted, 'rb') as fd:
+            with open(built, 'rb') as built_fd:
+                self.assertEqual(fd.read(), built_fd.read())
+
+
+class ConvertLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'test.index')
+        self.log = self.path + '.log'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, *args):
+        result = CliRunner().invoke(
+            cli, ['--corrector-index', self.path, 'convert'] + list(args),
+            obj={})
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_log_only_when_written(self):
+        dump = os.path.join(self.tmp_dir, 'dump.csv')
+        with open(dump, 'w') as fd:
+            fd.write('keyword,docs,hits,offset\nnight,1,300,0\nlamp,1,100,0\n')
+        self.convert('--sphinx-dump', dump)
+        self.assertFalse(os.path.exists(self.log))
+        delta = os.path.join(self.tmp_dir, 'delta.txt')
+        with open(delta, 'w') as fd:
+            fd.write('1000\tlantern\n')
+        self.convert('--delta', delta)
+        self.assertTrue(os.path.getsize(self.log))
+        self.convert('--compact')
+        self.assertEqual(os.path.getsize(self.log), 0)
+        self.assertIn(u'lantern', TypoDefault(self.path).good_words)
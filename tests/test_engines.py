@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from itertools import groupby
+from operator import itemgetter
+
+import Levenshtein
+
+from typo.correctors import TypoDefault
+from typo.correctors.engines import NumpyEngine, numpy
+
+from helpers import write_index
+
+
+def random_words(rng, first, lengths, count, letters=u'abcdefg'):
+    return set(first + u''.join(rng.choice(letters) for _ in range(length - 1))
+               for length in lengths for _ in range(count))
+
+
+def misspell(rng, word, letters=u'abcdefg'):
+    # a word one or two edits away from word
+    for _ in range(rng.randint(1, 2)):
+        i = rng.randint(1, len(word) - 1)
+        edit = rng.choice(('insert', 'delete', 'replace'))
+        if edit == 'insert':
+            word = word[:i] + rng.choice(letters) + word[i:]
+        elif edit == 'delete' and len(word) > 2:
+            word = word[:i] + word[i + 1:]
+        else:
+            word = word[:i] + rng.choice(letters) + word[i + 1:]
+    return word
+
+
+class EngineTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        # a bucket of more than MIN_BUCKET words of the first letter and
+        # length, small ones of the lengths around
+        words = random_words(rng, u'a', [7], 2 * NumpyEngine.MIN_BUCKET)
+        words |= random_words(rng, u'a', [5, 6, 8, 9], 100)
+        words |= random_words(rng, u'b', [5, 6, 7], 100)
+        self.words = sorted(words)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'test.index')
+        write_index(self.path, [(word, rng.randint(1, 1000))
+                                for word in self.words])
+        self.queries = [misspell(rng, rng.choice(self.words))
+                        for _ in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def scans(self, engine, enough=None):
+        corrector = TypoDefault(self.path, engine=engine)
+        return [corrector.engine.scan(word, 2, enough)
+                for word in self.queries]
+
+    def test_bucketed_scan_is_the_full_scan(self):
+        corrector = TypoDefault(self.path, engine='python')
+        self.assertIsNotNone(corrector.corpus.buckets)
+        for word in self.queries:
+            full = []
+            for cword, weight in corrector.corpus[ord(word[0])].items():
+                d = Levenshtein.distance(cword, word)
+                if d <= 2:
+                    full.append((cword, weight, d))
+            self.assertEqual(corrector.engine.scan(word, 2), full)
+
+    def test_scan_stops_at_enough(self):
+        for found, enough_found in zip(self.scans('python'),
+                                       self.scans('python', enough=1)):
+            self.assertTrue(set(enough_found) <= set(found))
+            if any(d == 1 for _, _, d in enough_found):
+                # the words at distance 1 are all there
+                self.assertEqual([f for f in enough_found if f[2] == 1],
+                                 [f for f in found if f[2] == 1])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_scan_is_the_python_scan(self):
+        corrector = TypoDefault(self.path, engine='numpy')
+        _, buckets = corrector.engine.buckets(ord(u'a'))
+        self.assertIsNotNone(buckets[7].columns)
+        self.assertEqual(self.scans('numpy'), self.scans('python'))
+        self.assertEqual(self.scans('numpy', enough=1),
+                         self.scans('python', enough=1))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_engine_corrects_like_the_deletion_index(self):
+        deletes = TypoDefault(self.path, max_candidates=100)
+        # a dictionary that small is scanned
+        deletes.scan_words = 0
+        deletes.reload()
+        scan = TypoDefault(self.path, max_candidates=100, engine='numpy')
+        for word in self.queries:
+            self.assertEqual(
+                sorted(scan.find_candidates(word, max_candidates=100,
+                                            skip_distance=2)),
+                sorted(deletes.find_candidates(word, max_candidates=100,
+                                               skip_distance=2)))
+
+    def test_lookup_paths_rank_alike(self):
+        deletes = TypoDefault(self.path, max_candidates=100)
+        deletes.scan_words = 0
+        deletes.reload()
+        paths = [deletes, TypoDefault(self.path, max_candidates=100),
+                 TypoDefault(self.path, max_candidates=100, engine='python')]
+        if numpy is not None:
+            paths.append(TypoDefault(self.path, max_candidates=100,
+                                     engine='numpy'))
+        self.assertFalse(deletes.index.scan_corpus)
+        self.assertTrue(all(c.index.scan_corpus for c in paths[1:]))
+
+        def ranking(corrector, word, is_last):
+            # the words of every weight, best first: the order of the
+            # words of the same weight is not kept by the lookups
+            found = corrector.find_candidates(word, max_candidates=100,
+                                              skip_distance=2,
+                                              is_last=is_last)
+            return [(weight, sorted(cword for cword, _ in group))
+                    for weight, group in groupby(found, itemgetter(1))]
+
+        for word in self.queries:
+            for is_last in (False, True):
+                expected = ranking(deletes, word, is_last)
+                for corrector in paths[1:]:
+                    self.assertEqual(ranking(corrector, word, is_last),
+                                     expected)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from typo.correctors import TypoDefault
+from typo.correctors.utils import best_phrase
+
+from helpers import write_index
+
+WORDS = [(u'привет', 300), (u'мир', 200), (u'hello', 100)]
+
+
+class LayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'test.index')
+        write_index(path, WORDS)
+        self.corrector = TypoDefault(path, lang='ru')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def correct(self, phrase):
+        suggestions, ok = self.corrector.suggestion(phrase)
+        return best_phrase(suggestions), ok
+
+    def test_translated(self):
+        self.assertEqual(self.correct(u'ghbdtn'), (u'привет', True))
+        self.assertEqual(self.correct(u'ghbdtn, vbh'), (u'привет, мир', True))
+        self.assertEqual(self.correct(u'руддщ'), (u'hello', True))
+
+    def test_not_translated_to_punctuation(self):
+        # the keys of б, ю, ж, ё, х, э are punctuation in the en layout
+        for phrase in [u'бю', u'жёб', u'хэж']:
+            chunks = self.corrector.split_chunks(phrase)
+            self.assertIsNone(
+                self.corrector.layout_suggestion(phrase, chunks))
+            self.assertEqual(self.correct(phrase)[0], phrase)
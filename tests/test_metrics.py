@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from typo.metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter_reads_its_function(self):
+        metrics = Metrics()
+        hits = [3]
+        metrics.counter('typo_cache_hits_total', 'Candidate cache hits',
+                        function=lambda: hits[0])
+        hits[0] = 5
+        self.assertIn('# TYPE typo_cache_hits_total counter\n'
+                      'typo_cache_hits_total 5\n', metrics.render())
+        self.assertEqual(metrics.snapshot()['typo_cache_hits_total'], {'': 5})
+
+    def test_histogram_snapshot_is_cumulative(self):
+        metrics = Metrics()
+        histogram = metrics.histogram('typo_candidates', 'Candidates',
+                                      buckets=(1, 2))
+        for value in (0, 1, 2, 3):
+            histogram.observe(value)
+        self.assertEqual(metrics.snapshot()['typo_candidates']['']['buckets'],
+                         [(1, 2), (2, 3), ('+Inf', 4)])
+        self.assertIn('typo_candidates_bucket{le="1"} 2\n'
+                      'typo_candidates_bucket{le="2"} 3\n'
+                      'typo_candidates_bucket{le="+Inf"} 4\n',
+                      metrics.render())
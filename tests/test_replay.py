@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import trollius as asyncio
+from trollius import From
+
+from typo.cmd_replay import Replayer, parse_log_line
+from typo.cmd_server import TypedServer
+from typo.correctors import TypoDefault
+from typo.indexes import Indexes
+
+from helpers import write_index
+
+WORDS = [(u'night', 300), (u'street', 200), (u'lamp', 100)]
+
+
+class Lines(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+class KeepaliveLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'en.index')
+        write_index(self.path, WORDS)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        indexes = Indexes([('en', self.path, 'en')], TypoDefault)
+        self.server = TypedServer('127.0.0.1', 0, 1000, None, keepalive=True,
+                                  indexes=indexes)
+        self.server.start(self.loop)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+        self.log = Lines()
+        self.logger = logging.getLogger('typo.cmd_server')
+        self.level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.log)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.log)
+        self.logger.setLevel(self.level)
+        self.server.stop(self.loop)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.tmp_dir)
+
+    def ask(self, *requests):
+        @asyncio.coroutine
+        def exchange():
+            reader, writer = yield From(asyncio.open_connection(
+                '127.0.0.1', self.port))
+            replies = []
+            for request in requests:
+                writer.write(request + '\n')
+                line = yield From(reader.readline())
+                replies.append(line.rstrip('\n'))
+            writer.close()
+            raise asyncio.Return(replies)
+        return self.loop.run_until_complete(exchange())
+
+    def test_replay_of_the_log(self):
+        requests = ['QUERY en lanp', '@500 QUERY en nihgt',
+                    '#7 @500 QUERY en stret', '#8 TOP en 2 lanp']
+        self.assertEqual(self.ask(*requests),
+                         ['lamp', 'night', '#7 street', '#8 lamp'])
+        logged = [parse_log_line(line) for line in self.log.lines]
+        self.assertEqual([request.line for request in logged],
+                         ['QUERY en lanp', '@500 QUERY en nihgt',
+                          '@500 QUERY en stret', 'TOP en 2 lanp'])
+        self.assertEqual([request.expected for request in logged],
+                         ['lamp', 'night', 'street', 'lamp'])
+
+        replayer = Replayer('tcp://127.0.0.1:{}'.format(self.port), logged,
+                            concurrency=1, keepalive=True)
+        report = self.loop.run_until_complete(replayer.run())
+        self.assertEqual((report['completed'], report['compared'],
+                          report['mismatches'], report['errors']),
+                         (4, 4, 0, 0))
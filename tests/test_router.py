@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import trollius as asyncio
+from trollius import From
+
+from typo.cmd_router import ShardClient
+
+
+class ShardClientTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # a shard reading requests and never answering them
+        self.closed = []
+
+        @asyncio.coroutine
+        def silent(reader, writer):
+            while (yield From(reader.readline())):
+                pass
+            self.closed.append(writer)
+            writer.close()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(silent, '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.shard = ShardClient('tcp://127.0.0.1:{}'.format(port))
+
+    def tearDown(self):
+        self.shard.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_close_closes_the_requests_in_flight(self):
+        request = asyncio.Task(self.shard.request('CANDIDATES 1 2 word'))
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(len(self.shard.busy), 1)
+        self.shard.close()
+        # the request reads the end of its connection
+        self.assertRaises(asyncio.IncompleteReadError,
+                          self.loop.run_until_complete, request)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(len(self.closed), 1)
+        self.assertEqual(self.shard.busy, set())
+
+    def test_timeout_closes_the_connection(self):
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete,
+                          asyncio.wait_for(self.shard.request('PING'), 0.1))
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(len(self.closed), 1)
+        self.assertEqual((self.shard.busy, self.shard.idle), (set(), []))
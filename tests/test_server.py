@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import trollius as asyncio
+from trollius import From
+
+from typo.cmd_server import TypedServer
+from typo.correctors import TypoDefault
+from typo.indexes import Indexes
+
+from helpers import write_index
+
+WORDS = [(u'night', 300), (u'street', 200), (u'lamp', 100)]
+
+
+class PooledIndexesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'en.index')
+        write_index(self.path, WORDS)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        indexes = Indexes([('en', self.path, 'en')], TypoDefault)
+        self.server = TypedServer('127.0.0.1', 0, 1000, None, keepalive=True,
+                                  pool_size=1, indexes=indexes)
+        self.server.start(self.loop)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.stop(self.loop)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.tmp_dir)
+
+    def ask(self, *requests):
+        @asyncio.coroutine
+        def exchange():
+            reader, writer = yield From(asyncio.open_connection(
+                '127.0.0.1', self.port))
+            replies = []
+            for request in requests:
+                writer.write(request + '\n')
+                line = yield From(reader.readline())
+                replies.append(line.rstrip('\n'))
+            writer.close()
+            raise asyncio.Return(replies)
+        return self.loop.run_until_complete(exchange())
+
+    def test_update_reaches_the_pool(self):
+        self.assertEqual(self.ask('QUERY en lanterm'), ['lanterm'])
+        TypoDefault.add_delta(self.path, [(u'lantern', 1000)])
+        self.assertEqual(self.ask('UPDATE', 'QUERY en lanterm'),
+                         ['DONE', 'lantern'])
+
+    def test_unknown_index(self):
+        self.assertEqual(self.ask('QUERY fr lanterm'), ['ERROR'])
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from typo.correctors import storage
+
+from helpers import write_index
+
+WORDS = [(u'ночь', 300), (u'улица', 200), (u'фонарь', 100), (u'lamp', 50)]
+
+
+class MemoryWordTableTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'test.index')
+        write_index(self.path, WORDS)
+        self.memory = storage.IndexFile(self.path).words
+        memory_words = storage.MEMORY_WORDS
+        storage.MEMORY_WORDS = 0
+        try:
+            self.mapped = storage.IndexFile(self.path).words
+        finally:
+            storage.MEMORY_WORDS = memory_words
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_is_the_mapped_table(self):
+        self.assertTrue(self.memory.in_memory)
+        self.assertFalse(self.mapped.in_memory)
+        self.assertEqual(list(self.memory.items()), list(self.mapped.items()))
+        self.assertEqual(list(self.memory.items(1, 3)),
+                         list(self.mapped.items(1, 3)))
+        for word in [u'ночь', u'lamp', u'свет']:
+            self.assertEqual(word in self.memory, word in self.mapped)
+            self.assertEqual(self.memory.get(word), self.mapped.get(word))
+            self.assertEqual(self.memory.find(word.encode('utf-8')),
+                             self.mapped.find(word.encode('utf-8')))
+        self.assertEqual(self.memory[u'улица'], 200)
+        self.assertRaises(KeyError, self.memory.__getitem__, u'свет')
+
+
+class BuildTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = random.Random(1)
+        self.words = [(u''.join(rng.choice(u'abcdeабвгд')
+                                for _ in range(rng.randint(1, 9))),
+                       rng.randint(1, 1000))
+                      for _ in range(2000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build(self, name, **options):
+        path = os.path.join(self.tmp_dir, name)
+        write_index(path, self.words, **options)
+        with open(path, 'rb') as fd:
+            return fd.read()
+
+    def test_builds_are_the_same(self):
+        default = self.build('default.index')
+        # the sorted runs are spilled to files many times
+        self.assertEqual(self.build('spilled.index', memory_limit=16 << 10),
+                         default)
+        self.assertEqual(self.build('jobs.index', jobs=3), default)
+        self.assertEqual(self.build('both.index', memory_limit=16 << 10,
+                                    jobs=3), default)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['both.index', 'default.index', 'jobs.index',
+                          'spilled.index'])
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from typo.correctors import TypoDefault
+
+from helpers import write_index
+
+WORDS = [(u'night', 300), (u'street', 200), (u'lamp', 100)]
+NEW_WORDS = WORDS + [(u'lantern', 1000)]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def children(pid):
+    # pids of the processes pid has forked
+    result = []
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(name)) as fd:
+                    stat = fd.read()
+            except IOError:
+                continue
+            if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+                result.append(int(name))
+    return result
+
+
+@unittest.skipUnless(os.path.isdir('/proc'), 'needs /proc')
+class SupervisedServerTest(unittest.TestCase):
+    workers = 3
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'test.index')
+        write_index(self.path, WORDS)
+        self.port = free_port()
+        with open(os.devnull, 'w') as devnull:
+            self.master = subprocess.Popen(
+                [sys.executable, '-m', 'typo', '--corrector-index', self.path,
+                 'server', '--host', '127.0.0.1', '--port', str(self.port),
+                 '--workers', str(self.workers)], stderr=devnull)
+        self.wait_for(lambda: len(children(self.master.pid)) == self.workers
+                      and self.ask('QUERY lamp') == 'lamp')
+
+    def tearDown(self):
+        self.master.terminate()
+        self.master.wait()
+        shutil.rmtree(self.tmp_dir)
+
+    def wait_for(self, condition, timeout=10):
+        start = time.time()
+        while True:
+            try:
+                if condition():
+                    return
+            except socket.error:
+                pass
+            if time.time() - start > timeout:
+                self.fail('timed out')
+            time.sleep(0.1)
+
+    def ask(self, request):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        try:
+            sock.sendall(request + '\n')
+            return sock.makefile().readline().rstrip('\n')
+        finally:
+            sock.close()
+
+    def replace_index(self, words):
+        # the way convert does it, workers map the old file
+        tmp_path = self.path + '.tmp'
+        write_index(tmp_path, words)
+        os.rename(tmp_path, self.path)
+
+    def test_restarted_worker_has_the_reloaded_index(self):
+        self.assertEqual(self.ask('QUERY lanterm'), 'lanterm')
+        self.replace_index(NEW_WORDS)
+        os.kill(self.master.pid, signal.SIGHUP)
+        self.wait_for(lambda: all(self.ask('QUERY lanterm') == 'lantern'
+                                  for _ in range(10)))
+        old = children(self.master.pid)
+        for pid in old:
+            os.kill(pid, signal.SIGTERM)
+        self.wait_for(lambda: len(set(children(self.master.pid)) -
+                                  set(old)) == self.workers)
+        self.assertEqual(set(self.ask('QUERY lanterm') for _ in range(20)),
+                         {'lantern'})
+
+    def test_reload_reaches_all_the_workers(self):
+        self.replace_index(NEW_WORDS)
+        self.assertEqual(self.ask('RELOAD'), 'DONE')
+        self.wait_for(lambda: set(self.ask('QUERY lanterm')
+                                  for _ in range(20)) == {'lantern'})
+
+    def test_update_reaches_all_the_workers(self):
+        TypoDefault.add_delta(self.path, [(u'lantern', 1000)])
+        self.assertEqual(self.ask('UPDATE'), 'DONE')
+        self.wait_for(lambda: set(self.ask('QUERY lanterm')
+                                  for _ in range(20)) == {'lantern'})
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import math
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from itertools import groupby, product
+
+from typo.cmd_server import run_correction
+from typo.correctors import TypoDefault
+from typo.correctors.utils import Deadline, best_phrases
+
+from helpers import write_index
+
+
+def brute_best_phrases(suggestions, k):
+    # every phrase with the cost of its candidates, see best_phrases
+    phrases = []
+    for picks in product(*[range(len(candidates))
+                           for candidates in suggestions]):
+        words = []
+        cost = 0.0
+        for candidates, pick in zip(suggestions, picks):
+            words.append(candidates[pick][0])
+            cost += math.log(candidates[0][1] / float(candidates[pick][1]))
+        phrases.append((round(cost, 9), picks, u''.join(words)))
+    result = []
+    seen = set()
+    for cost, _, text in sorted(phrases):
+        if text not in seen:
+            seen.add(text)
+            result.append((text, cost))
+    return result[:k]
+
+
+def by_cost(phrases):
+    # [(cost, {phrases})], the order of phrases of the same cost is free
+    return [(cost, set(text for text, _ in group))
+            for cost, group in groupby(phrases, lambda phrase: phrase[1])]
+
+
+class BestPhrasesTest(unittest.TestCase):
+    def random_suggestions(self, rng):
+        suggestions = []
+        for i in range(rng.randint(1, 4)):
+            if i:
+                suggestions.append([(u' ', 1)])
+            # weights repeat, a word may be a candidate twice
+            weights = sorted((rng.choice([100, 50, 50, 25, 1])
+                              for _ in range(rng.randint(1, 4))),
+                             reverse=True)
+            suggestions.append([(rng.choice(u'abcd') + str(i), weight)
+                                for weight in weights])
+        return suggestions
+
+    def test_is_the_brute_force(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            suggestions = self.random_suggestions(rng)
+            k = rng.randint(1, 10)
+            result = [(text, round(-math.log(weight), 9))
+                      for text, weight in best_phrases(suggestions, k)]
+            expected = brute_best_phrases(suggestions, k)
+            self.assertEqual(len(result), len(expected))
+            result, expected = by_cost(result), by_cost(expected)
+            self.assertEqual([cost for cost, _ in result],
+                             [cost for cost, _ in expected])
+            # the phrases of the last cost may be cut by k
+            self.assertEqual(result[:-1], expected[:-1])
+            last_cost, last = result[-1]
+            self.assertTrue(last <= set(
+                text for text, cost in brute_best_phrases(suggestions, 1000)
+                if cost == last_cost))
+
+    def test_ties_and_repeated_words(self):
+        suggestions = [[(u'a', 10), (u'b', 10), (u'a', 5)], [(u' ', 1)],
+                       [(u'c', 10), (u'd', 10)]]
+        result = best_phrases(suggestions, 10)
+        self.assertEqual(sorted(text for text, _ in result[:4]),
+                         [u'a c', u'a d', u'b c', u'b d'])
+        self.assertEqual([weight for _, weight in result], [1.0] * 4)
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'test.index')
+        write_index(path, [(u'night', 300), (u'street', 200), (u'lamp', 100)])
+        self.corrector = TypoDefault(path, lang='en')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_expired(self):
+        deadline = Deadline(0)
+        self.assertEqual(self.corrector.find_candidates(
+            u'nigth', deadline=deadline), [])
+        # the glued words and the lookups
+        self.assertEqual(deadline.skipped, 2)
+        self.assertTrue(deadline.partial)
+
+        deadline = Deadline(0)
+        suggestions, ok = self.corrector.suggestion(u'nigth lamp', deadline)
+        # a known word is not looked up
+        self.assertEqual(deadline.skipped, 2)
+        self.assertTrue(deadline.partial)
+        self.assertEqual(suggestions,
+                         [[(u'nigth', 1)], [(u' ', 1)], [(u'lamp', 1)]])
+        self.assertFalse(ok)
+
+    def test_not_expired(self):
+        deadline = Deadline(60)
+        suggestions, ok = self.corrector.suggestion(u'nigth lamp', deadline)
+        self.assertEqual((suggestions[0][0][0], ok), (u'night', True))
+        self.assertFalse(deadline.partial)
+
+    def test_partial_reply(self):
+        self.assertEqual(run_correction(self.corrector, 'QUERY nigth lamp',
+                                        None, Deadline(0)),
+                         'PARTIAL nigth lamp')
+        self.assertEqual(run_correction(self.corrector, 'QUERY nigth lamp',
+                                        None, Deadline(60)),
+                         'night lamp')
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+The WSGI app of a corrector, served by uWSGI (typo.wsgi) and by the
+http command (typo.cmd_http).
+"""
+import cgi
+import json
+from timeit import default_timer
+
+from correctors.utils import Deadline, best_phrases
+from metrics import instrument_corrector
+
+
+def make_app(corrector, format, limit=10, metrics=None, deadline=0,
+             indexes=None):
+    """
+    With metrics the corrector is instrumented and /metrics serves them.
+    The search of a request takes at most its deadline=<ms> parameter
+    or deadline ms, a result cut short by it has an X-Typo-Partial header.
+
+    With indexes (see typo.indexes) instead of corrector a request names
+    its index by the index=<name> parameter.
+    """
+    if metrics is not None:
+        if indexes is not None:
+            indexes.instrument(metrics)
+        else:
+            instrument_corrector(corrector, metrics)
+
+    def render(suggestions):
+        if format == 'json':
+            return json.dumps(suggestions, ensure_ascii=False)
+        # the best limit phrases, best first
+        return u'\n'.join(phrase for phrase, weight
+                          in best_phrases(suggestions, limit))
+
+    def render_many(results):
+        # a JSON array of the results, or a line of alternatives
+        # separated by tabs per phrase, in the order of the phrases
+        if format == 'json':
+            yield '['
+            for i, (suggestions, _) in enumerate(results):
+                yield (',' if i else '') + render(suggestions).encode('utf-8')
+            yield ']'
+        else:
+            for suggestions, _ in results:
+                line = render(suggestions).replace(u'\n', u'\t')
+                yield line.encode('utf-8') + '\n'
+
+    def headers(budget):
+        result = [('Content-Type', 'text/plain; charset=UTF-8')]
+        if budget is not None and budget.partial:
+            result.append(('X-Typo-Partial', '1'))
+        return result
+
+    def correct(env, start_response):
+        method = env['REQUEST_METHOD']
+        qs = cgi.parse_qs(env.get('QUERY_STRING', ''))
+        budget = qs.get('deadline', [''])[0]
+        if budget and not budget.isdigit():
+            start_response('400 Bad Request', [])
+            return []
+        budget = int(budget) if budget else deadline
+        budget = Deadline(budget / 1000.0) if budget else None
+        suggest = corrector
+        if indexes is not None:
+            name = qs.get('index', [''])[0]
+            if not name:
+                start_response('400 Bad Request', [])
+                return []
+            if name not in indexes:
+                start_response('404 Not Found', [])
+                return []
+            suggest = indexes.get(name)
+        if method == 'GET':
+            typo = qs.get('query', [''])[0]
+        elif method == 'POST':
+            typo = env['wsgi.input'].read()
+        else:
+            start_response('405 Method Not Allowed', [])
+            return []
+        typo = typo.decode('utf-8').strip()
+
+        if method == 'POST' and typo.startswith(u'['):
+            # a batch: JSON array of phrases
+            try:
+                phrases = json.loads(typo)
+            except ValueError:
+                phrases = None
+            if not isinstance(phrases, list) or \
+                    not all(isinstance(p, basestring) for p in phrases):
+                start_response('400 Bad Request', [])
+                return []
+            results = suggest.suggestion_many(
+                (p.strip() for p in phrases), budget)
+            if budget is not None:
+                # the header is known when the phrases are corrected
+                results = list(results)
+            start_response('200 OK', headers(budget))
+            return render_many(results)
+
+        suggestions, _ = suggest.suggestion(typo, budget)
+        start_response('200 OK', headers(budget))
+        return [render(suggestions).encode('utf-8')]
+
+    if metrics is None:
+        return correct
+    return with_metrics(correct, metrics)
+
+
+def with_metrics(app, metrics):
+    """ app counting and timing its requests, /metrics serves the metrics """
+    def application(env, start_response):
+        if env.get('PATH_INFO') == '/metrics':
+            start_response('200 OK',
+                           [('Content-Type', 'text/plain; version=0.0.4')])
+            return [metrics.render()]
+
+        start = default_timer()
+        statuses = []
+
+        def status_response(status, headers, *exc_info):
+            statuses.append(status)
+            return start_response(status, headers, *exc_info)
+
+        method = env['REQUEST_METHOD']
+        try:
+            return app(env, status_response)
+        finally:
+            metrics.counter('typo_requests_total', 'Requests by method',
+                            method=method).inc()
+            if not statuses or not statuses[-1].startswith('2'):
+                metrics.counter('typo_errors_total', 'Failed requests by method',
+                                method=method).inc()
+            metrics.histogram('typo_request_seconds', 'Time to handle a request',
+                              method=method).observe(default_timer() - start)
+    return application
@@ -7,14 +7,22 @@ import click
 from correctors import TYPO_CLASSES
 from cmd_console import console_group
 from cmd_server import server_group
+from cmd_http import http_group
 from cmd_convert import convert_group
+from cmd_bench import bench_group
+from cmd_replay import replay_group
+from cmd_router import router_group
 
 logger = logging.getLogger(__name__)
 
 
 @click.command(cls=click.CommandCollection,
-               sources=[server_group, convert_group, console_group])
+               sources=[server_group, http_group, convert_group,
+                        console_group, bench_group, replay_group,
+                        router_group])
 @click.option('--debug', is_flag=True, default=False)
+@click.option('--log-time', is_flag=True, default=False,
+              help='Start the log lines with the time, replay keeps it')
 @click.option('--corrector-index',
               type=click.Path(readable=True, resolve_path=True),
               default="index.data",
@@ -22,11 +30,15 @@ logger = logging.getLogger(__name__)
 @click.option('--corrector', type=click.Choice(TYPO_CLASSES.keys()),
               default='default')
 @click.pass_context
-def cli(ctx, debug, corrector_index, corrector):
+def cli(ctx, debug, log_time, corrector_index, corrector):
     ctx.obj['corrector'] = TYPO_CLASSES.get(corrector)
     ctx.obj['corrector_index'] = corrector_index
     ctx.obj['debug'] = debug
-    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+    log_format = logging.BASIC_FORMAT
+    if log_time:
+        log_format = '%(asctime)s ' + log_format
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO,
+                        format=log_format)
 
 if __name__ == '__main__':
     cli(obj={})
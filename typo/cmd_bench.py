@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import logging
+import resource
+import sys
+from collections import defaultdict
+from timeit import default_timer
+
+import click
+
+from correctors.engines import ENGINES
+from correctors.utils import best_phrase
+
+logger = logging.getLogger(__name__)
+
+
+def read_pairs(filename):
+    """ Lines of "misspelled<TAB>correct" phrases, # starts a comment """
+    pairs = []
+    with io.open(filename, encoding='utf-8') as fd:
+        for line in fd:
+            line = line.strip()
+            if not line or line.startswith(u'#'):
+                continue
+            typo, correct = line.split(u'\t', 1)
+            pairs.append((typo.strip(), correct.strip()))
+    return pairs
+
+
+def percentile(values, percent):
+    # nearest rank, values are sorted
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return dict(
+        count=len(latencies),
+        p50=percentile(latencies, 50) * 1000,
+        p95=percentile(latencies, 95) * 1000,
+        p99=percentile(latencies, 99) * 1000,
+        max=latencies[-1] * 1000,
+    )
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes elsewhere
+    return rss / 1024.0 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def run_bench(inst, pairs, repeat=1):
+    latencies = defaultdict(list)
+    correct = 0
+    start = default_timer()
+    for _ in range(repeat):
+        for typo, expected in pairs:
+            query_start = default_timer()
+            suggestions, _ = inst.suggestion(typo)
+            latency = default_timer() - query_start
+            length = sum(1 for chunk, mode in inst.split_chunks(typo) if mode)
+            latencies[length].append(latency)
+            if best_phrase(suggestions) == expected:
+                correct += 1
+    total_time = default_timer() - start
+
+    queries = len(pairs) * repeat
+    everything = [l for values in latencies.values() for l in values]
+    return dict(
+        phrases=len(pairs),
+        queries=queries,
+        total_time=total_time,
+        qps=queries / total_time if total_time else None,
+        accuracy=float(correct) / queries,
+        latency_ms=dict(
+            all=latency_summary(everything),
+            by_words=dict((str(length), latency_summary(values))
+                          for length, values in latencies.items()),
+        ),
+    )
+
+
+@click.group()
+def bench_group():
+    pass
+
+
+@bench_group.command()
+@click.option('--pairs', type=click.Path(exists=True, resolve_path=True),
+              required=True,
+              help='File of "misspelled<TAB>correct" phrases per line')
+@click.option('--repeat', type=click.IntRange(1, None), default=1)
+@click.option('--max-candidates', type=click.IntRange(1, None), default=1)
+@click.option('--engine', type=click.Choice(sorted(ENGINES)))
+@click.option('--engine-memory', type=click.IntRange(0, None), default=0,
+              help='Memory for the first letters kept by the engine (MB), '
+                   '0 does not limit it')
+@click.option('--output', type=click.File('w'), default='-')
+@click.pass_context
+def bench(ctx, pairs, repeat, max_candidates, engine, engine_memory, output):
+    """Measure speed and accuracy of a corrector, the report is JSON"""
+
+    corrector_index = ctx.obj['corrector_index']
+    corrector_cls = ctx.obj['corrector']
+
+    start = default_timer()
+    inst = corrector_cls(corrector_index, max_candidates=max_candidates,
+                         engine=engine, engine_memory=engine_memory << 20)
+    load_time = default_timer() - start
+
+    report = dict(
+        corrector=corrector_cls.typo_name,
+        engine=engine,
+        index=corrector_index,
+        load_time=load_time,
+    )
+    report.update(run_bench(inst, read_pairs(pairs), repeat=repeat))
+    report['max_rss_mb'] = max_rss_mb()
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
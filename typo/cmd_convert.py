@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import io
 import logging
 import os
 from collections import namedtuple
+from contextlib import contextmanager
 
 import click
-import marshal
+
+from correctors.delta import locked, log_path, read_delta
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +15,47 @@ ClientTuple = namedtuple('ClientTuple', 'timeout, reader, writer')
 WordTuple = namedtuple('WordTuple', 'keyword, docs, hits, offset')
 
 
+@contextmanager
+def replace_on_success(path):
+    """
+    Write to a temporary file renamed to path at the end: servers map
+    the index, so it must not be truncated under them.
+    """
+    tmp_path = '{}.tmp'.format(path)
+    try:
+        with open(tmp_path, 'w+b') as fd:
+            yield fd
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+@contextmanager
+def existing_log(path, compact=False):
+    """
+    The log of the index at path locked, see delta.locked, None if the
+    index has none: a new index does not get an empty one
+    """
+    if not compact and not os.path.exists(log_path(path)):
+        yield None
+        return
+    with locked(path) as log:
+        yield log
+
+
+def parse_shard(value):
+    # (i, shards) of "I/N", None without it
+    if value is None:
+        return None
+    i, sep, shards = value.partition('/')
+    if not sep or not i.isdigit() or not shards.isdigit() or \
+            not int(i) < int(shards):
+        raise click.BadParameter('not I/N with I < N: {}'.format(value),
+                                 param_hint='--shard')
+    return int(i), int(shards)
+
+
 def is_writable(file):
     try:
         open(file, 'a')
@@ -33,28 +77,113 @@ def convert_group():
 @click.option('--frequency-dict',
               type=click.Path(readable=True, resolve_path=True))
 @click.option('--min-hits', type=click.INT, default=0)
+@click.option('--memory-limit', type=click.IntRange(16, None), default=512,
+              help='Memory for sorting the dictionary (MB), the rest is '
+                   'sorted in temporary files next to the index')
+@click.option('--phrases', type=click.Path(readable=True, resolve_path=True),
+              help='Text in utf-8 to build a bigram model of')
+@click.option('--min-pair-count', type=click.IntRange(1, None), default=2,
+              help='Times a pair of words is seen in phrases to be kept')
+@click.option('--delta', type=click.Path(readable=True, resolve_path=True),
+              help='Words added, changed ("<hits>\\t<word>") and removed '
+                   '("-\\t<word>") to append to the log of the index')
+@click.option('--compact', is_flag=True, default=False,
+              help='Write the log of the index into it')
+@click.option('--jobs', type=click.IntRange(1, None), default=1,
+              help='Processes building the postings of the words, the '
+                   'index is the same')
+@click.option('--shard',
+              help='I/N: build shard I of N for the router, with the '
+                   'postings and the corpus of its first letters only')
 @click.pass_context
-def convert(ctx, sphinx_dump=None, frequency_dict=None, min_hits=0):
+def convert(ctx, sphinx_dump=None, frequency_dict=None, min_hits=0,
+            memory_limit=512, phrases=None, min_pair_count=2, delta=None,
+            compact=False, jobs=1, shard=None):
     """
     A converter from sphinx format to internal corrector format.
     Use indextool --dumpdict to dump the sphinx dictionary.
 
     Frequency dict for Russian can be downloaded from
     http://www.ruscorpora.ru/corpora-freq.html.
-    """
-    assert bool(sphinx_dump) ^ bool(frequency_dict)
 
-    if frequency_dict:
-        convert_frequency(ctx, frequency_dict, min_hits=min_hits)
+    A delta is appended to the log of the index, servers get it with
+    UPDATE. A compaction or a new index empties the log.
+
+    The N shards of a dictionary are served each by a server, the
+    router command corrects with all of them. A compaction keeps the
+    shard of the index.
+    """
+    assert sum(map(bool, (sphinx_dump, frequency_dict, delta, compact))) == 1
+    shard = parse_shard(shard)
+    if shard is not None and (delta or compact):
+        raise click.UsageError('--shard builds a new index')
+
+    if delta:
+        append_delta(ctx, delta)
+        return
+
+    options = dict(memory_limit=memory_limit << 20, phrases=phrases,
+                   min_pair_count=min_pair_count, jobs=jobs)
+    if shard is not None:
+        options['shard'] = shard
+    if compact:
+        compact_log(ctx, **options)
+    elif frequency_dict:
+        convert_frequency(ctx, frequency_dict, min_hits=min_hits, **options)
     else:
-        convert_sphinx(ctx, sphinx_dump, min_hits=min_hits)
+        convert_sphinx(ctx, sphinx_dump, min_hits=min_hits, **options)
+
+
+def export(ctx, items, memory_limit, phrases=None, min_pair_count=2,
+           compact=False, jobs=1, shard=None):
+    corrector = ctx.obj['corrector']
+    corrector_index = ctx.obj['corrector_index']
+    click.echo("Export result to {}".format(corrector_index))
+    phrase_lines = io.open(phrases, encoding='utf-8') if phrases else None
+    options = dict(memory_limit=memory_limit,
+                   tmp_dir=os.path.dirname(corrector_index),
+                   phrases=phrase_lines,
+                   min_pair_count=min_pair_count,
+                   jobs=jobs)
+    try:
+        # the log is of the old index, appending waits for the new one
+        with existing_log(corrector_index, compact) as log:
+            with replace_on_success(corrector_index) as fd_out:
+                if compact:
+                    corrector.compact(corrector_index, fd_out, **options)
+                else:
+                    corrector.convert(items, fd_out, shard=shard, **options)
+            if log is not None:
+                log.truncate(0)
+    finally:
+        if phrase_lines is not None:
+            phrase_lines.close()
+
+
+def append_delta(ctx, delta):
+    corrector = ctx.obj['corrector']
+    corrector_index = ctx.obj['corrector_index']
+    try:
+        records = read_delta(delta)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--delta')
+    corrector.add_delta(corrector_index, records)
+    click.echo("Appended {} records to the log of {}"
+               .format(len(records), corrector_index))
+
+
+def compact_log(ctx, **options):
+    corrector_index = ctx.obj['corrector_index']
+    click.echo("Compact the log of {}".format(corrector_index))
+    export(ctx, None, compact=True, **options)
+    click.echo("//EOE")
 
 
-def convert_frequency(ctx, frequency_dict=None, min_hits=0):
+def convert_frequency(ctx, frequency_dict=None, min_hits=0, **options):
     def progress(file):
         stat = os.stat(file.name)
         with click.progressbar(length=stat.st_size, label='Converting') as bar:
-            for line in file.readlines():
+            for line in file:
                 bar.update(len(line))
                 yield line
 
@@ -75,19 +204,16 @@ def convert_frequency(ctx, frequency_dict=None, min_hits=0):
         raise RuntimeError('do not have write permission to {}'
                            .format(corrector_index))
 
-    with open(frequency_dict) as fd, open(corrector_index, 'w') as fd_out:
-        items = clean(progress(fd))
-        result = corrector.convert(items)
-        click.echo("Export result to {}".format(corrector_index))
-        fd_out.write(marshal.dumps(result))
+    with open(frequency_dict) as fd:
+        export(ctx, clean(progress(fd)), **options)
     click.echo("//EOE")
 
 
-def convert_sphinx(ctx, sphinx_dump=None, min_hits=0):
+def convert_sphinx(ctx, sphinx_dump=None, min_hits=0, **options):
     def progress(file):
         stat = os.stat(file.name)
         with click.progressbar(length=stat.st_size, label='Converting') as bar:
-            for line in file.readlines():
+            for line in file:
                 bar.update(len(line))
                 yield line
 
@@ -122,11 +248,8 @@ def convert_sphinx(ctx, sphinx_dump=None, min_hits=0):
         raise RuntimeError('do not have write permission to {}'
                            .format(corrector_index))
 
-    with open(sphinx_dump) as fd, open(corrector_index, 'w') as fd_out:
-        items = clean(skip_header(progress(fd)))
-        result = corrector.convert(items)
-        click.echo("Export result to {}".format(corrector_index))
-        fd_out.write(marshal.dumps(result))
+    with open(sphinx_dump) as fd:
+        export(ctx, clean(skip_header(progress(fd))), **options)
     click.echo("//EOE")
 
 
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+import io
+import logging
+import sys
+import urllib
+from collections import namedtuple
+
+import click
+import trollius as asyncio
+from trollius import From
+
+from app import make_app, with_metrics
+from cmd_server import (ClientTuple, TypedServer, listen, make_correctors,
+                        supervise)
+from correctors.engines import ENGINES
+
+logger = logging.getLogger(__name__)
+
+Request = namedtuple('Request', 'method, target, version, headers, body, '
+                                'keep_alive')
+MAX_HEADERS = 100  # header lines of a request
+
+
+class HttpError(Exception):
+    """ A request that is answered status and closes the connection """
+
+    def __init__(self, status):
+        super(HttpError, self).__init__(status)
+        self.status = status
+
+
+class HttpServer(TypedServer):
+    """
+    The API of the WSGI app (typo.app.make_app) over HTTP/1.1, served by
+    the event loop: GET /?query=, POST of a phrase or of a JSON array
+    of phrases, GET /metrics.
+
+    Connections are persistent unless the client asks to close them or
+    speaks HTTP/1.0 without keep-alive, and are closed when idle for
+    idle_timeout. Requests may be pipelined, they are answered one by
+    one in their order. A request has timeout to arrive once its first
+    line is read, a body longer than max_body is refused.
+
+    Reloads and updates of the index are those of TypedServer.
+    """
+
+    def __init__(self, host, port, corrector, format='text', limit=10,
+                 timeout=5000, idle_timeout=60000, max_body=1 << 20,
+                 watch_interval=0, deadline=0, indexes=None):
+        super(HttpServer, self).__init__(host, port, timeout, corrector,
+                                         keepalive=True,
+                                         idle_timeout=idle_timeout,
+                                         watch_interval=watch_interval,
+                                         deadline=deadline, indexes=indexes)
+        self.max_body = max_body
+        # the corrector is instrumented by the server already
+        self.app = with_metrics(make_app(corrector, format, limit,
+                                         deadline=deadline, indexes=indexes),
+                                self.metrics)
+
+    def on_connect(self, reader, writer):
+        client = ClientTuple(timeout=None, reader=reader, writer=writer)
+        task = asyncio.Task(self.process_http(client))
+        task.add_done_callback(self.on_disconnect)
+        self.connections[task] = client
+        client_ip = self.client_ip(client)
+        logger.debug("{client}:connect".format(client=client_ip))
+
+    @asyncio.coroutine
+    def read_request(self, client, line):
+        parts = line.split()
+        if len(parts) != 3:
+            raise HttpError('400 Bad Request')
+        method, target, version = parts
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise HttpError('505 HTTP Version Not Supported')
+
+        headers = []
+        while True:
+            line = yield From(client.reader.readline())
+            if not line:
+                raise asyncio.IncompleteReadError(line, None)
+            line = line.rstrip('\r\n')
+            if not line:
+                break
+            name, sep, value = line.partition(':')
+            if not sep or len(headers) == MAX_HEADERS:
+                raise HttpError('400 Bad Request')
+            headers.append((name.strip().lower(), value.strip()))
+        fields = dict(headers)
+
+        connection = fields.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = 'keep-alive' in connection
+        else:
+            keep_alive = 'close' not in connection
+
+        encoding = fields.get('transfer-encoding', '').lower()
+        length = fields.get('content-length', '0')
+        if encoding and encoding != 'chunked':
+            raise HttpError('501 Not Implemented')
+        if not encoding and not length.isdigit():
+            raise HttpError('400 Bad Request')
+        if not encoding and int(length) > self.max_body:
+            raise HttpError('413 Request Entity Too Large')
+        if fields.get('expect', '').lower() == '100-continue':
+            client.writer.write('HTTP/1.1 100 Continue\r\n\r\n')
+
+        if encoding:
+            body = yield From(self.read_chunked(client))
+        else:
+            body = yield From(client.reader.readexactly(int(length)))
+        raise asyncio.Return(Request(method, target, version, headers, body,
+                                     keep_alive))
+
+    @asyncio.coroutine
+    def read_chunked(self, client):
+        chunks = []
+        size = 0
+        while True:
+            line = yield From(client.reader.readline())
+            chunk_size = line.split(';', 1)[0].strip()
+            try:
+                chunk_size = int(chunk_size, 16)
+            except ValueError:
+                raise HttpError('400 Bad Request')
+            if not chunk_size:
+                break
+            size += chunk_size
+            if size > self.max_body:
+                raise HttpError('413 Request Entity Too Large')
+            chunks.append((yield From(client.reader.readexactly(chunk_size))))
+            yield From(client.reader.readexactly(2))  # CRLF
+        # trailers
+        while True:
+            line = yield From(client.reader.readline())
+            if not line:
+                raise asyncio.IncompleteReadError(line, None)
+            if not line.strip():
+                break
+        raise asyncio.Return(''.join(chunks))
+
+    def environ(self, client, request):
+        path, _, query = request.target.partition('?')
+        host, port = client.writer.transport.get_extra_info('sockname')[:2]
+        remote = client.writer.transport.get_extra_info('peername')
+        env = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': request.version,
+            'REMOTE_ADDR': remote[0],
+            'CONTENT_LENGTH': str(len(request.body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers:
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if key in env and key.startswith('HTTP_'):
+                value = env[key] + ',' + value
+            env[key] = value
+        return env
+
+    def respond(self, client, request):
+        """ (status, headers, body) of the app for a request """
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        try:
+            body = ''.join(self.app(self.environ(client, request),
+                                    start_response))
+        except Exception:
+            logger.exception('Failed to handle {} {}'
+                             .format(request.method, request.target))
+            return '500 Internal Server Error', [], ''
+        status, headers = response
+        return status, headers, body
+
+    def write_response(self, client, status, headers, body, keep_alive):
+        lines = ['HTTP/1.1 {}'.format(status)]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers)
+        lines.append('Content-Length: {}'.format(len(body)))
+        lines.append('Connection: {}'
+                     .format('keep-alive' if keep_alive else 'close'))
+        client.writer.write('\r\n'.join(lines) + '\r\n\r\n' + body)
+
+    @asyncio.coroutine
+    def process_http(self, client):
+        client_ip = self.client_ip(client)
+        while True:
+            try:
+                line = yield From(asyncio.wait_for(client.reader.readline(),
+                                                   timeout=self.idle_timeout))
+                if not line:
+                    break
+                if not line.strip():
+                    # an empty line before a request is ignored
+                    continue
+                request = yield From(asyncio.wait_for(
+                    self.read_request(client, line), timeout=self.timeout))
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                break
+            except (HttpError, ValueError) as e:
+                # ValueError: a line longer than the limit of the reader
+                status = getattr(e, 'status', '400 Bad Request')
+                self.write_response(client, status, [], '', False)
+                yield From(client.writer.drain())
+                logger.info("{client}:request:{status}"
+                            .format(client=client_ip, status=status))
+                break
+
+            status, headers, body = self.respond(client, request)
+            self.write_response(client, status, headers, body,
+                                request.keep_alive)
+            yield From(client.writer.drain())
+            logger.info("{client}:request:{method} {target}:{status}"
+                        .format(client=client_ip, method=request.method,
+                                target=request.target, status=status))
+            if not request.keep_alive:
+                break
+
+
+@click.group()
+def http_group():
+    pass
+
+
+@http_group.command()
+@click.option('--host', type=str, default='0.0.0.0', required=True)
+@click.option('--port', type=click.IntRange(1, 65535), default=8080,
+              required=True)
+@click.option('--timeout', type=click.IntRange(1, 60000), default=5000,
+              help='Time a request may take to arrive once it started (ms)')
+@click.option('--idle-timeout', type=click.IntRange(1, None), default=60000,
+              help='Close idle connections after it (ms)')
+@click.option('--max-body', type=click.IntRange(1, None), default=1024,
+              help='Longest request body (KB)')
+@click.option('--format', type=click.Choice(['text', 'json']),
+              default='text')
+@click.option('--limit', type=click.IntRange(1, None), default=10,
+              help='Phrases of a text reply')
+@click.option('--cache-size', type=click.IntRange(0, None), default=0,
+              help='Number of cached words, 0 disables the cache')
+@click.option('--engine', type=click.Choice(sorted(ENGINES)),
+              help='Scan the corpus with it rather than look the words '
+                   'up in the deletion index of the index')
+@click.option('--engine-memory', type=click.IntRange(0, None), default=0,
+              help='Memory for the first letters kept by the engine (MB), '
+                   'the least recently used ones are dropped beyond it, '
+                   '0 does not limit it')
+@click.option('--max-candidates', type=click.IntRange(1, None), default=1,
+              help='Candidates of a word, a reply combines them')
+@click.option('--workers', type=click.IntRange(1, None), default=1,
+              help='Number of processes accepting on the port')
+@click.option('--watch', type=click.IntRange(0, None), default=0,
+              help='Reload the index when its file changes, checked '
+                   'every N seconds, 0 disables it')
+@click.option('--deadline', type=click.IntRange(0, None), default=0,
+              help='Time the search for a correction may take (ms), 0 '
+                   'disables it')
+@click.option('--index', 'index_specs', multiple=True,
+              help='NAME=PATH[:LANG] of an index to host instead of '
+                   '--corrector-index, requests name it by index=<name>')
+@click.option('--index-memory', type=click.IntRange(0, None), default=0,
+              help='Memory for the hosted indexes (MB), the least recently '
+                   'used ones are dropped beyond it, 0 does not limit it')
+@click.pass_context
+def http(ctx, host, port, timeout, idle_timeout, max_body, format, limit,
+         cache_size, engine, engine_memory, max_candidates, workers, watch,
+         deadline, index_specs, index_memory):
+    """Typod HTTP server"""
+
+    corrector_cls = ctx.obj['corrector']
+    inst, indexes = make_correctors(ctx, index_specs, index_memory,
+                                    cache_size=cache_size, engine=engine,
+                                    engine_memory=engine_memory << 20,
+                                    max_candidates=max_candidates)
+    server = HttpServer(host=host,
+                        port=port,
+                        corrector=inst,
+                        format=format,
+                        limit=limit,
+                        timeout=timeout,
+                        idle_timeout=idle_timeout,
+                        max_body=max_body << 10,
+                        watch_interval=watch,
+                        deadline=deadline,
+                        indexes=indexes)
+
+    if workers > 1:
+        logger.info('Run HTTP server on {}:{}, using {} corrector, {} workers'
+                    .format(host, port, corrector_cls.typo_name, workers))
+        sock = listen(host, port)
+        try:
+            supervise(server, sock, workers)
+        finally:
+            sock.close()
+        return
+
+    loop = asyncio.get_event_loop()
+    logger.info('Run HTTP server on {}:{}, using {} corrector'
+                .format(host, port, corrector_cls.typo_name))
+    server.start(loop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+import cgi
+import io
+import json
+import logging
+import re
+import time
+import urllib
+from collections import namedtuple
+from timeit import default_timer
+from urlparse import urlparse
+
+import click
+import trollius as asyncio
+from trollius import From
+
+from cmd_bench import latency_summary
+from cmd_server import PARTIAL
+
+logger = logging.getLogger(__name__)
+
+# command is QUERY or TOP, k the phrases of TOP, deadline the ms of the
+# search or None, expected the logged reply or None, line the logged TCP
+# request or None
+Request = namedtuple('Request',
+                     'time, command, k, deadline, phrase, expected, line')
+
+LOG_TIME = re.compile(r'^(\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d)(?:[.,](\d+))?\s')
+
+
+def parse_time(line):
+    # seconds of the asctime a log line starts with (--log-time), or None
+    match = LOG_TIME.match(line)
+    if match is None:
+        return None
+    seconds = time.mktime(time.strptime(match.group(1).replace('T', ' '),
+                                        '%Y-%m-%d %H:%M:%S'))
+    if match.group(2):
+        seconds += float('0.' + match.group(2))
+    return seconds
+
+
+def split_result(rest):
+    """
+    "<request>:<result>" of a request logged by the TCP server. A phrase
+    may have colons, the corrector keeps them: an odd number of colons is
+    split in the middle, otherwise at the last one.
+    """
+    colons = rest.count(':')
+    if colons % 2 == 0:
+        return rest.rpartition(':')[::2]
+    position = -1
+    for _ in range(colons // 2 + 1):
+        position = rest.index(':', position + 1)
+    return rest[:position], rest[position + 1:]
+
+
+def parse_command(line, when=None, expected=None):
+    """
+    Request of a QUERY or TOP line, optionally "@<ms> " first, or None. The
+    line is sent as it is to a TCP server, the phrase of a server hosting
+    indexes starts with the index of a QUERY.
+    """
+    request, deadline = line, None
+    if line.startswith('@'):
+        ms, _, rest = line[1:].partition(' ')
+        if ms.isdigit():
+            deadline, line = int(ms), rest
+    command, _, phrase = line.partition(' ')
+    k = None
+    if command == 'TOP':
+        k, _, phrase = phrase.partition(' ')
+        if not k.isdigit():
+            # "TOP <index> <k> <phrase>" of a server hosting indexes
+            k, _, phrase = phrase.partition(' ')
+        if not k.isdigit():
+            return None
+        k = int(k)
+    elif command != 'QUERY':
+        return None
+    if not phrase:
+        return None
+    return Request(when, command, k, deadline, phrase, expected, request)
+
+
+def parse_log_line(line):
+    """
+    Request of a "<client>:request:<request>:<result>" line of the TCP
+    server or of a "<client>:request:GET <target>:<status>" line of the
+    HTTP server, None for the other lines and commands
+    """
+    head, sep, rest = line.rstrip('\r\n').partition(':request:')
+    if not sep:
+        return None
+    when = parse_time(head)
+    if rest.startswith('GET '):
+        target = rest[4:].rpartition(':')[0]
+        qs = cgi.parse_qs(urlparse(target).query)
+        phrase = qs.get('query', [''])[0].strip()
+        deadline = qs.get('deadline', [''])[0]
+        if not phrase:
+            return None
+        return Request(when, 'QUERY', None,
+                       int(deadline) if deadline.isdigit() else None,
+                       phrase, None, None)
+    request, result = split_result(rest)
+    if request.startswith('#'):
+        # a request with an id and its reply
+        request = request.partition(' ')[2]
+        result = result.partition(' ')[2]
+    return parse_command(request, when, result)
+
+
+def read_requests(log=None, queries=None):
+    """ Requests of a server log or of a file of a phrase per line """
+    requests = []
+    with io.open(log or queries, 'rb') as fd:
+        for line in fd:
+            if log:
+                request = parse_log_line(line)
+            elif line.strip():
+                request = Request(None, 'QUERY', None, None, line.strip(),
+                                  None, None)
+            else:
+                request = None
+            if request is not None:
+                requests.append(request)
+    return requests
+
+
+def normalize(reply):
+    # (reply without the PARTIAL prefix, is partial)
+    if reply.startswith(PARTIAL):
+        return reply[len(PARTIAL):], True
+    return reply, False
+
+
+class Replayer(object):
+    """
+    Send requests to a typod server from concurrency connections at
+    once (a connection per request unless keepalive), each request at
+    its time from the start if the times are given. The latency of a
+    late request counts from its time, not from when it is sent.
+    """
+
+    def __init__(self, url, requests, times=None, concurrency=16,
+                 timeout=1000, keepalive=False, diffs=None):
+        url = urlparse(url)
+        if url.scheme not in ('tcp', 'http'):
+            raise ValueError('not a tcp:// or http:// url: {}'
+                             .format(url.geturl()))
+        self.scheme = url.scheme
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or (3333 if url.scheme == 'tcp' else 80)
+        self.path = url.path or '/'
+        self.requests = requests
+        self.times = times
+        self.concurrency = concurrency
+        self.timeout = timeout / 1000.0
+        self.keepalive = keepalive
+        self.diffs = diffs
+        self.queue = None
+        self.latencies = []
+        self.counts = dict(sent=0, completed=0, errors=0, timeouts=0, busy=0,
+                           partial=0, compared=0, mismatches=0)
+
+    def tcp_line(self, request):
+        if request.line is not None:
+            # as logged, with the deadline and the index of the request
+            return request.line
+        if request.command == 'TOP':
+            line = 'TOP {} {}'.format(request.k, request.phrase)
+        else:
+            line = 'QUERY {}'.format(request.phrase)
+        if request.deadline is not None:
+            line = '@{} {}'.format(request.deadline, line)
+        return line
+
+    def http_target(self, request):
+        params = [('query', request.phrase)]
+        if request.deadline is not None:
+            params.append(('deadline', request.deadline))
+        return '{}?{}'.format(self.path, urllib.urlencode(params))
+
+    @asyncio.coroutine
+    def send_tcp(self, reader, writer, request):
+        writer.write(self.tcp_line(request) + '\n')
+        reply = yield From(reader.readline())
+        if not reply:
+            raise asyncio.IncompleteReadError(reply, None)
+        raise asyncio.Return(reply.rstrip('\r\n'))
+
+    @asyncio.coroutine
+    def send_http(self, reader, writer, request):
+        writer.write('GET {} HTTP/1.1\r\nHost: {}:{}\r\n{}\r\n'.format(
+            self.http_target(request), self.host, self.port,
+            '' if self.keepalive else 'Connection: close\r\n'))
+        status = yield From(reader.readline())
+        if not status:
+            raise asyncio.IncompleteReadError(status, None)
+        headers = {}
+        while True:
+            line = yield From(reader.readline())
+            if not line.strip():
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            body = yield From(reader.readexactly(
+                int(headers['content-length'])))
+        else:
+            body = yield From(reader.read())
+        if status.split(' ', 2)[1:2] != ['200']:
+            raise asyncio.Return('ERROR')
+        # the reply of the TCP server to the request
+        lines = body.split('\n')
+        reply = lines[0] if request.command == 'QUERY' else \
+            '\t'.join(lines[:request.k])
+        if headers.get('x-typo-partial') == '1':
+            reply = PARTIAL + reply
+        raise asyncio.Return(reply)
+
+    @asyncio.coroutine
+    def connect(self):
+        connection = yield From(asyncio.open_connection(self.host, self.port))
+        raise asyncio.Return(connection)
+
+    @asyncio.coroutine
+    def exchange(self, connection, request):
+        if connection is None:
+            connection = yield From(self.connect())
+        send = self.send_tcp if self.scheme == 'tcp' else self.send_http
+        reply = yield From(send(connection[0], connection[1], request))
+        raise asyncio.Return((connection, reply))
+
+    def observe(self, request, reply, latency):
+        counts = self.counts
+        counts['completed'] += 1
+        self.latencies.append(latency)
+        if reply == 'ERROR':
+            counts['errors'] += 1
+            return
+        if reply == 'BUSY':
+            counts['busy'] += 1
+            return
+        reply, partial = normalize(reply)
+        if partial:
+            counts['partial'] += 1
+        if request.expected is None:
+            return
+        expected, expected_partial = normalize(request.expected)
+        if partial or expected_partial:
+            # a search cut short says nothing of the index
+            return
+        counts['compared'] += 1
+        if reply != expected:
+            counts['mismatches'] += 1
+            if self.diffs is not None:
+                self.diffs.write('{}\t{}\t{}\n'.format(
+                    self.tcp_line(request), expected, reply))
+
+    @asyncio.coroutine
+    def worker(self):
+        connection = None
+        while True:
+            item = yield From(self.queue.get())
+            if item is None:
+                break
+            request, scheduled = item
+            start = default_timer()
+            self.counts['sent'] += 1
+            try:
+                connection, reply = yield From(asyncio.wait_for(
+                    self.exchange(connection, request), self.timeout))
+            except asyncio.TimeoutError:
+                self.counts['timeouts'] += 1
+                reply = None
+            except (EnvironmentError, asyncio.IncompleteReadError,
+                    ValueError) as e:
+                logger.debug('Failed to send {!r}: {}'.format(request, e))
+                self.counts['errors'] += 1
+                reply = None
+            if reply is None or not self.keepalive:
+                if connection is not None:
+                    connection[1].close()
+                connection = None
+            if reply is not None:
+                self.observe(request, reply,
+                             default_timer() - (scheduled or start))
+        if connection is not None:
+            connection[1].close()
+
+    @asyncio.coroutine
+    def dispatch(self, start):
+        for i, request in enumerate(self.requests):
+            scheduled = None
+            if self.times is not None:
+                scheduled = start + self.times[i]
+                delay = scheduled - default_timer()
+                if delay > 0:
+                    yield From(asyncio.sleep(delay))
+            yield From(self.queue.put((request, scheduled)))
+        for _ in range(self.concurrency):
+            yield From(self.queue.put(None))
+
+    @asyncio.coroutine
+    def run(self):
+        """ The report of the replay """
+        self.queue = asyncio.Queue()
+        start = default_timer()
+        workers = [asyncio.Task(self.worker())
+                   for _ in range(self.concurrency)]
+        yield From(self.dispatch(start))
+        yield From(asyncio.wait(workers))
+        duration = default_timer() - start
+
+        report = dict(self.counts)
+        report.update(
+            requests=len(self.requests),
+            duration=duration,
+            qps=self.counts['completed'] / duration if duration else None,
+            latency_ms=latency_summary(self.latencies)
+            if self.latencies else None,
+        )
+        raise asyncio.Return(report)
+
+
+def schedule(requests, qps=0, speed=1.0):
+    """
+    Seconds from the start to send every request at: qps a second, or the
+    times of the log sped up by speed, None to send them at once
+    """
+    if qps:
+        return [i / float(qps) for i in range(len(requests))]
+    if not speed or not requests or \
+            any(request.time is None for request in requests):
+        return None
+    first = requests[0].time
+    return [max(0.0, (request.time - first) / speed) for request in requests]
+
+
+@click.group()
+def replay_group():
+    pass
+
+
+@replay_group.command()
+@click.option('--url', required=True,
+              help='Server to replay to: tcp://host:port or http://host:port/')
+@click.option('--log', type=click.Path(exists=True, resolve_path=True),
+              help='Log of a server, its QUERY and TOP requests (and GET '
+                   'requests of the HTTP server) are replayed')
+@click.option('--queries', type=click.Path(exists=True, resolve_path=True),
+              help='File of a phrase per line to send as QUERY')
+@click.option('--concurrency', type=click.IntRange(1, None), default=16,
+              help='Requests sent at once, a connection each')
+@click.option('--qps', type=click.FLOAT, default=0,
+              help='Requests a second, 0 keeps the times of the log')
+@click.option('--speed', type=click.FLOAT, default=1.0,
+              help='How much faster than logged the requests are sent, 0 '
+                   'sends them as fast as concurrency allows')
+@click.option('--timeout', type=click.IntRange(1, None), default=1000,
+              help='Time a reply may take (ms)')
+@click.option('--keepalive', is_flag=True, default=False,
+              help='Send the requests of a connection over it one by one')
+@click.option('--diffs', type=click.File('w'),
+              help='File of "request<TAB>logged<TAB>replied" lines for '
+                   'the replies that differ from the log')
+@click.option('--output', type=click.File('w'), default='-')
+def replay(url, log, queries, concurrency, qps, speed, timeout, keepalive,
+           diffs, output):
+    """
+    Replay the requests of a log to a server, the report is JSON.
+
+    Logs of a server started with --log-time keep the time between the
+    requests, other logs and queries are sent at --qps or as fast as
+    --concurrency allows. Replies are compared to the logged ones.
+    """
+    if bool(log) == bool(queries):
+        raise click.UsageError('Give either --log or --queries')
+    requests = read_requests(log, queries)
+    times = schedule(requests, qps, speed)
+    try:
+        replayer = Replayer(url, requests, times, concurrency=concurrency,
+                            timeout=timeout, keepalive=keepalive, diffs=diffs)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--url')
+
+    loop = asyncio.get_event_loop()
+    try:
+        report = loop.run_until_complete(replayer.run())
+    finally:
+        loop.close()
+    report['url'] = url
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
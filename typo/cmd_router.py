@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+from collections import defaultdict
+from operator import itemgetter
+from timeit import default_timer
+from urlparse import urlparse
+
+import click
+import trollius as asyncio
+from trollius import From
+
+from cmd_server import (PARTIAL, TypedServer, listen, run_correction,
+                        supervise)
+from correctors.default import shard_of
+from correctors.utils import Deadline
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetched(object):
+    """
+    The corrector with the candidates of the words found beforehand: a
+    word not found is recorded in missing and has none, a word of
+    incomplete makes the reply partial.
+    """
+
+    def __init__(self, corrector, found, incomplete=()):
+        self.corrector = corrector
+        self.found = found
+        self.incomplete = incomplete
+        self.missing = []
+
+    def candidates(self, word, max_candidates, skip_distance, is_last,
+                   deadline=None):
+        key = (word, is_last, max_candidates, skip_distance)
+        if key not in self.found:
+            if key not in self.missing:
+                self.missing.append(key)
+            return []
+        if key in self.incomplete and deadline is not None:
+            deadline.skipped += 1
+        return list(self.found[key])
+
+    def suggestion(self, phrase, deadline=None):
+        return self.corrector.phrase_suggestion(phrase, self.candidates,
+                                                deadline)
+
+    def suggestion_many(self, phrases, deadline=None):
+        for phrase in phrases:
+            yield self.suggestion(phrase, deadline)
+
+
+def close_opened(opening):
+    # the connection of a done open_connection task, if it made one
+    if not opening.cancelled() and opening.exception() is None:
+        opening.result()[1].close()
+
+
+class ShardClient(object):
+    """
+    Keepalive connections to a shard server, up to size of them at once,
+    a request at a time each. A connection closed by the server while it
+    was idle is opened again. close() closes the connections of the
+    requests in flight too.
+    """
+
+    def __init__(self, url, size=8):
+        url = urlparse(url)
+        if url.scheme != 'tcp':
+            raise ValueError('not a tcp:// url: {}'.format(url.geturl()))
+        self.url = url.geturl()
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or 3333
+        self.size = size
+        self.idle = []
+        # writers of the requests in flight
+        self.busy = set()
+        # made in the loop of the worker, see supervise
+        self.semaphore = None
+
+    @asyncio.coroutine
+    def request(self, line):
+        """ The reply line to line, IncompleteReadError if there is none """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.size)
+        yield From(self.semaphore.acquire())
+        try:
+            reply = yield From(self.exchange(line))
+        finally:
+            self.semaphore.release()
+        raise asyncio.Return(reply)
+
+    @asyncio.coroutine
+    def exchange(self, line):
+        while True:
+            reused = bool(self.idle)
+            if reused:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = yield From(self.connect())
+            self.busy.add(writer)
+            try:
+                writer.write(line + '\n')
+                reply = yield From(reader.readline())
+            except Exception:
+                # cancelled by the timeout, the reply would come late
+                writer.close()
+                raise
+            finally:
+                self.busy.discard(writer)
+            if reply:
+                self.idle.append((reader, writer))
+                raise asyncio.Return(reply.rstrip('\r\n'))
+            writer.close()
+            if not reused:
+                raise asyncio.IncompleteReadError(reply, None)
+
+    @asyncio.coroutine
+    def connect(self):
+        # the opening is not cancelled with the request, the connection
+        # it makes after that is closed rather than left half open
+        opening = asyncio.Task(asyncio.open_connection(self.host, self.port))
+        try:
+            connection = yield From(asyncio.shield(opening))
+        except asyncio.CancelledError:
+            opening.add_done_callback(close_opened)
+            raise
+        raise asyncio.Return(connection)
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+        while self.busy:
+            self.busy.pop().close()
+
+
+class RouterServer(TypedServer):
+    """
+    A TypedServer correcting with the shards of an index (see convert
+    --shard), shard i of the shard urls serves shard i of them. The
+    corrector is of any of the shards, all have the words: a word of
+    the dictionary, glued words, the keyboard layouts and the bigrams
+    are done by the router, the lookups of a word in the postings and
+    the corpus by the shards owning them (two at most), at once.
+
+    A shard is given shard_timeout ms to answer, the words it did not
+    answer are corrected with the candidates of the others and the
+    reply is PARTIAL.
+    """
+
+    def __init__(self, host, port, timeout, corrector, shards,
+                 shard_timeout=100, connections=8, **options):
+        super(RouterServer, self).__init__(host, port, timeout, corrector,
+                                           **options)
+        self.shards = [ShardClient(url, connections) for url in shards]
+        self.shard_timeout = shard_timeout / 1000.0
+
+    @asyncio.coroutine
+    def correct(self, query, phrases=None, deadline=None, index=None):
+        if query.startswith('CANDIDATES'):
+            # the router is not a shard
+            raise asyncio.Return('ERROR')
+        # the words of the request first, then their candidates at once
+        words = Prefetched(self.corrector, {})
+        run_correction(words, query, phrases)
+        found = {}
+        incomplete = set()
+        results = yield From(asyncio.gather(
+            *[self.fetch(key, deadline) for key in words.missing]))
+        for key, (candidates, complete) in zip(words.missing, results):
+            found[key] = candidates
+            if not complete:
+                incomplete.add(key)
+        if incomplete and deadline is None:
+            # a deadline that is never over, to mark the reply partial
+            deadline = Deadline(float('inf'))
+        raise asyncio.Return(run_correction(
+            Prefetched(self.corrector, found, incomplete), query, phrases,
+            deadline))
+
+    @asyncio.coroutine
+    def fetch(self, key, deadline=None):
+        """
+        (candidates, complete) of a word as find_candidates, with the
+        lookups of the shards, complete is False when a shard failed or
+        cut its search short
+        """
+        word, is_last, max_candidates, skip_distance = key
+        corrector = self.corrector
+        skip_distance = max(min(skip_distance, len(word) // 2), 1)
+        if word in corrector.good_words:
+            raise asyncio.Return((corrector.return_as_is(word), True))
+
+        candidates = defaultdict(list)
+        glued = None
+        complete = True
+        if deadline is not None and deadline.exceeded():
+            complete = False
+        else:
+            glued = corrector.handle_glued(word, candidates, skip_distance,
+                                           is_last)
+            owners = sorted(set(
+                shard_of(lookup_key, len(self.shards)) for lookup_key, _
+                in corrector.lookup_steps(word, skip_distance)))
+            line = 'CANDIDATES {} {} {}'.format(max_candidates, skip_distance,
+                                                word.encode('utf-8'))
+            replies = yield From(asyncio.gather(
+                *[self.ask(self.shards[i], line, deadline) for i in owners]))
+            found = []
+            for reply, partial in replies:
+                found.extend(reply)
+                complete = complete and not partial
+            # the lookups in the order of find_candidates, a shard
+            # answers every lookup it owns
+            found.sort(key=itemgetter(0))
+            for step, d, cword, cweight in found:
+                candidates[d].append((cword, cweight))
+        raise asyncio.Return((corrector.pick_candidates(
+            word, candidates, glued, skip_distance, max_candidates, is_last),
+            complete))
+
+    @asyncio.coroutine
+    def ask(self, shard, line, deadline=None):
+        # (lookups of a shard, partial), none if it failed
+        if deadline is not None:
+            budget = int((deadline.at - time.time()) * 1000)
+            if budget <= 0:
+                raise asyncio.Return(([], True))
+            line = '@{} {}'.format(budget, line)
+        metrics = self.metrics
+        start = default_timer()
+        metrics.counter('typo_shard_requests_total', 'Requests by shard',
+                        shard=shard.url).inc()
+        try:
+            reply = yield From(asyncio.wait_for(shard.request(line),
+                                                self.shard_timeout))
+            partial = reply.startswith(PARTIAL)
+            found = json.loads(reply[len(PARTIAL):] if partial else reply)
+        except asyncio.TimeoutError:
+            metrics.counter('typo_shard_timeouts_total',
+                            'Shard requests over the shard timeout',
+                            shard=shard.url).inc()
+            raise asyncio.Return(([], True))
+        except (EnvironmentError, asyncio.IncompleteReadError, ValueError) as e:
+            # ERROR and BUSY are not JSON
+            logger.warning('Shard {} failed: {}'.format(shard.url, e))
+            metrics.counter('typo_shard_errors_total', 'Failed shard requests',
+                            shard=shard.url).inc()
+            raise asyncio.Return(([], True))
+        metrics.histogram('typo_shard_seconds', 'Time of a shard request',
+                          shard=shard.url).observe(default_timer() - start)
+        raise asyncio.Return((found, partial))
+
+    def stop(self, loop):
+        super(RouterServer, self).stop(loop)
+        for shard in self.shards:
+            shard.close()
+
+
+@click.group()
+def router_group():
+    pass
+
+
+@router_group.command()
+@click.option('--host', type=str, default='0.0.0.0', required=True)
+@click.option('--port', type=click.IntRange(1, 65535), default=3333,
+              required=True)
+@click.option('--timeout', type=click.IntRange(1, 5000), default=1000,
+              required=True)
+@click.option('--shard', 'shard_urls', multiple=True, required=True,
+              help='tcp://host:port of a keepalive server of a shard, in '
+                   'the order of the shards')
+@click.option('--shard-timeout', type=click.IntRange(1, None), default=100,
+              help='Time a shard may take to answer (ms), the reply is '
+                   'PARTIAL without its candidates')
+@click.option('--connections', type=click.IntRange(1, None), default=8,
+              help='Connections to a shard at once (per worker)')
+@click.option('--max-candidates', type=click.IntRange(1, None), default=1,
+              help='Candidates of a word, TOP combines them')
+@click.option('--workers', type=click.IntRange(1, None), default=1,
+              help='Number of processes accepting on the port')
+@click.option('--keepalive', is_flag=True, default=False,
+              help='Keep connections open for pipelined requests')
+@click.option('--idle-timeout', type=click.IntRange(1, None), default=60000,
+              help='Close idle keepalive connections after it (ms)')
+@click.option('--max-inflight', type=click.IntRange(1, None), default=64,
+              help='Requests of a keepalive connection served at once')
+@click.option('--deadline', type=click.IntRange(0, None), default=0,
+              help='Time the search for a correction may take (ms), the '
+                   'best found by then is answered PARTIAL, 0 disables it')
+@click.pass_context
+def router(ctx, host, port, timeout, shard_urls, shard_timeout, connections,
+           max_candidates, workers, keepalive, idle_timeout, max_inflight,
+           deadline):
+    """
+    Typod server correcting with the servers of the shards of an index.
+
+    --corrector-index is any of the shards, see convert --shard.
+    """
+
+    corrector_index = ctx.obj['corrector_index']
+    corrector_cls = ctx.obj['corrector']
+    inst = corrector_cls(corrector_index, max_candidates=max_candidates)
+    shard = inst.shard
+    if shard is not None and shard[1] != len(shard_urls):
+        raise click.BadParameter('{} is a shard of {}, not of {}'.format(
+            corrector_index, shard[1], len(shard_urls)), param_hint='--shard')
+    try:
+        server = RouterServer(host=host,
+                              port=port,
+                              timeout=timeout,
+                              corrector=inst,
+                              shards=shard_urls,
+                              shard_timeout=shard_timeout,
+                              connections=connections,
+                              keepalive=keepalive,
+                              idle_timeout=idle_timeout,
+                              max_inflight=max_inflight,
+                              deadline=deadline)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--shard')
+
+    if workers > 1:
+        logger.info('Run router on {}:{} to {} shards, {} workers'
+                    .format(host, port, len(shard_urls), workers))
+        sock = listen(host, port)
+        try:
+            supervise(server, sock, workers)
+        finally:
+            sock.close()
+        return
+
+    loop = asyncio.get_event_loop()
+    logger.info('Run router on {}:{} to {} shards'
+                .format(host, port, len(shard_urls)))
+    server.start(loop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
@@ -1,35 +1,194 @@
 # -*- coding: utf-8 -*-
+import errno
+import json
 import logging
-from collections import namedtuple
+import os
+import signal
+import socket
+import time
+from collections import deque, namedtuple
 
 import click
 import trollius as asyncio
+from concurrent.futures import ProcessPoolExecutor
 from trollius import From
+from timeit import default_timer
+
+from correctors.delta import log_path
+from correctors.engines import ENGINES
+from correctors.utils import Deadline, best_phrase, best_phrases
+from indexes import Indexes, parse_index
+from metrics import Metrics, instrument_corrector
 
 logger = logging.getLogger(__name__)
 
 ClientTuple = namedtuple('ClientTuple', 'timeout, reader, writer')
+COMMANDS = ('QUERY', 'TOP', 'BATCH', 'CANDIDATES', 'RELOAD', 'UPDATE',
+            'STATS')
+# run in the pool, if there is one
+CORRECTIONS = ('QUERY', 'TOP', 'BATCH', 'CANDIDATES')
+MAX_TOP = 100  # phrases of a TOP reply
+PARTIAL = 'PARTIAL '  # prefix of a correction cut short by the deadline
+
+# the corrector (or the hosted indexes) of the pool processes, they
+# get it when they are forked
+pool_corrector = None
+pool_indexes = None
+pool_process = {}
+
+
+def run_correction(corrector, query, phrases=None, deadline=None):
+    """
+    The reply to QUERY, TOP or BATCH. A line corrected with the search
+    cut short by the deadline is prefixed by "PARTIAL ".
+    """
+    def line(text, skipped):
+        if deadline is not None and deadline.skipped > skipped:
+            return PARTIAL + text
+        return text
+
+    skipped = deadline.skipped if deadline is not None else 0
+    cmd = query.split(' ', 1)
+    if cmd[0] == 'QUERY' and len(cmd) > 1:
+        data = cmd[1]
+        typo = unicode(data, "utf-8")
+
+        suggestions, is_success = corrector.suggestion(typo, deadline)
+        return line(best_phrase(suggestions).encode('utf-8'), skipped)
+    elif cmd[0] == 'TOP' and len(cmd) > 1:
+        # TOP <k> <phrase>: the k best phrases separated by tabs
+        k, _, data = cmd[1].partition(' ')
+        if k.isdigit() and data:
+            typo = unicode(data, "utf-8")
+
+            suggestions, is_success = corrector.suggestion(typo, deadline)
+            k = min(max(int(k), 1), MAX_TOP)
+            return line(u'\t'.join(
+                phrase for phrase, weight
+                in best_phrases(suggestions, k)).encode('utf-8'), skipped)
+    elif cmd[0] == 'CANDIDATES' and len(cmd) > 1:
+        # CANDIDATES <max candidates> <skip distance> <word>: the lookups
+        # of a shard as JSON, see TypoDefault.shard_candidates
+        args = cmd[1].split(' ', 2)
+        if len(args) == 3 and args[0].isdigit() and args[1].isdigit():
+            found = corrector.shard_candidates(unicode(args[2], "utf-8"),
+                                               max_candidates=int(args[0]),
+                                               skip_distance=int(args[1]),
+                                               deadline=deadline)
+            return line(json.dumps(found, ensure_ascii=False).encode('utf-8'),
+                        skipped)
+    elif cmd[0] == 'BATCH' and phrases is not None:
+        typos = (unicode(data, "utf-8") for data in phrases)
+        lines = []
+        for suggestions, is_success in corrector.suggestion_many(typos,
+                                                                 deadline):
+            lines.append(line(best_phrase(suggestions).encode('utf-8'),
+                              skipped))
+            if deadline is not None:
+                skipped = deadline.skipped
+        return '\n'.join(lines)
+    return 'ERROR'
+
+
+def pool_run_correction(query, phrases=None, deadline=None, index=None):
+    if pool_process.get('pid') != os.getpid():
+        # signals are handled by the server, it may have forked the pool
+        # with the handlers of its event loop
+        pool_process['pid'] = os.getpid()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    corrector = pool_corrector if index is None else pool_indexes.get(index)
+    return run_correction(corrector, query, phrases, deadline)
 
 
 class TypedServer(object):
+    """
+    By default a connection carries one request and is closed after
+    timeout. In keepalive mode it carries any number of pipelined
+    requests until it is idle for idle_timeout. A request may be
+    prefixed by "#<id> ", then its reply gets the same prefix and is
+    written as soon as it is ready, replies without an id keep order.
+
+    "BATCH <n>" is followed by n lines of phrases and is answered by
+    n lines of corrections in the same order. "CANDIDATES <max> <skip>
+    <word>" is the lookup of a word by the router (see typo.cmd_router)
+    in the shard of the index served.
 
-    def __init__(self, host, port, timeout, corrector):
+    RELOAD, SIGHUP and a change of the index file (with watch_interval)
+    load the index in a thread, the old one serves until it is loaded.
+    UPDATE, SIGUSR1 and a change of its log put the records appended to
+    the log since on top of the loaded index. Under supervise RELOAD and
+    UPDATE are sent to the master as SIGHUP and SIGUSR1, which forwards
+    them to all the workers.
+
+    STATS returns the metrics of the process as a line of JSON.
+
+    A request may be prefixed by "@<ms> " (after the id), the time the
+    search of the corrector may take, deadline is the default one. The
+    corrections of a search cut short by it are prefixed by "PARTIAL ".
+
+    With pool_size corrections run in that many processes forked with
+    the loaded index, so a slow one does not hold the event loop. When
+    queue_limit of them are waiting or running, the next ones are
+    answered BUSY at once. A reload forks a new pool.
+
+    With indexes (see typo.indexes) the server hosts named indexes
+    instead of corrector, a correction names its index after the
+    command: "QUERY <index> <phrase>", "TOP <index> <k> <phrase>",
+    "BATCH <index> <n>". Reloads and updates are of the loaded ones.
+    """
+
+    def __init__(self, host, port, timeout, corrector, keepalive=False,
+                 idle_timeout=60000, max_inflight=64, max_batch=10000,
+                 watch_interval=0, pool_size=0, queue_limit=256, deadline=0,
+                 indexes=None):
         self.server = None
         self.loop = None
         self.corrector = corrector
+        self.indexes = indexes
         self.connections = {}
         self.timers = {}
         self.listen_host = host
         self.listen_port = port
-        self.timeout = timeout / 1000
+        self.timeout = timeout / 1000.0
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout / 1000.0
+        self.max_inflight = max_inflight
+        self.max_batch = max_batch
+        self.watch_interval = watch_interval
+        self.watch_mtimes = {}  # index file -> mtime
+        self.watch_log_sizes = {}  # index file -> size of its log
+        self.reloading = None
+        # pid of the master forking the workers, see supervise
+        self.supervisor = None
+        self.pool_size = pool_size
+        self.queue_limit = queue_limit
+        self.pool = None
+        self.queued = 0
+        self.deadline = deadline
+        self.metrics = Metrics()
+        self.metrics.gauge('typo_connections', 'Open connections',
+                           function=lambda: len(self.connections))
+        self.metrics.gauge('typo_queue_depth',
+                           'Corrections waiting or running in the pool',
+                           function=lambda: self.queued)
+        if self.indexes is not None:
+            self.indexes.instrument(self.metrics)
+        else:
+            instrument_corrector(self.corrector, self.metrics)
 
     def on_connect(self, reader, writer):
         client = ClientTuple(timeout=None, reader=reader, writer=writer)
-        task = asyncio.Task(self.process(client))
+        if self.keepalive:
+            task = asyncio.Task(self.process_pipeline(client))
+        else:
+            task = asyncio.Task(self.process(client))
+            timer = self.loop.call_later(self.timeout, self.on_disconnect, task)
+            self.timers[task] = timer
         task.add_done_callback(self.on_disconnect)
         self.connections[task] = client
-        timer = self.loop.call_later(self.timeout, self.on_disconnect, task)
-        self.timers[task] = timer
         client_ip = self.client_ip(client)
         logger.debug("{client}:connect".format(client=client_ip))
 
@@ -50,6 +209,286 @@ class TypedServer(object):
             del self.connections[task]
             logger.debug("{client}:disconnect".format(client=client_ip))
 
+    @asyncio.coroutine
+    def read_batch(self, client, query, timeout):
+        # phrases of a BATCH request, None for other and broken requests
+        cmd = query.split(' ', 1)
+        if cmd[0] != 'BATCH' or len(cmd) < 2 or not cmd[1].isdigit():
+            raise asyncio.Return(None)
+        count = int(cmd[1])
+        if not 0 < count <= self.max_batch:
+            raise asyncio.Return(None)
+        phrases = []
+        for _ in range(count):
+            line = yield From(asyncio.wait_for(client.reader.readline(),
+                                               timeout=timeout))
+            if not line:
+                raise asyncio.Return(None)
+            phrases.append(line.strip())
+        raise asyncio.Return(phrases)
+
+    @asyncio.coroutine
+    def reload(self):
+        # concurrent requests share one reload
+        if self.reloading is None or self.reloading.done():
+            self.reloading = asyncio.Task(self.load_index())
+        result = yield From(asyncio.shield(self.reloading))
+        raise asyncio.Return(result)
+
+    def correctors(self):
+        """ The correctors served, those of the loaded indexes with indexes """
+        if self.indexes is not None:
+            return self.indexes.correctors()
+        return [self.corrector]
+
+    @asyncio.coroutine
+    def load_index(self):
+        result = True
+        for corrector in self.correctors():
+            start = time.time()
+            try:
+                index = yield From(self.loop.run_in_executor(None,
+                                                             corrector.load))
+            except Exception:
+                logger.exception('Failed to reload {}'
+                                 .format(corrector.filename))
+                result = False
+                continue
+            corrector.install(index)
+            duration = time.time() - start
+            self.metrics.histogram('typo_reload_seconds',
+                                   'Time to reload the index').observe(duration)
+            logger.info('Reloaded {} in {:.3f}s (load {:.3f}s)'
+                        .format(corrector.filename, duration,
+                                index.load_time))
+        if self.pool is not None:
+            self.start_pool()
+        raise asyncio.Return(result)
+
+    @asyncio.coroutine
+    def update(self):
+        result = True
+        updated_any = False
+        for corrector in self.correctors():
+            start = time.time()
+            index = corrector.index
+            try:
+                updated = yield From(self.loop.run_in_executor(
+                    None, corrector.load_update, index))
+            except Exception:
+                logger.exception('Failed to update {}'
+                                 .format(corrector.filename))
+                result = False
+                continue
+            # a reload done meanwhile has read the log itself
+            if updated is not index and corrector.index is index:
+                corrector.install(updated)
+                updated_any = True
+                duration = time.time() - start
+                self.metrics.histogram(
+                    'typo_update_seconds',
+                    'Time to update the index').observe(duration)
+                logger.info('Updated {} in {:.3f}s ({} words changed)'
+                            .format(corrector.filename, duration,
+                                    len(updated.delta)))
+        # the pool processes load the hosted indexes themselves, the ones
+        # they have loaded are not among the correctors of the server
+        if self.pool is not None and (updated_any or self.indexes is not None):
+            self.start_pool()
+        raise asyncio.Return(result)
+
+    def signal_supervisor(self, signum):
+        # the other workers do the same, the reply is of this one
+        if self.supervisor is not None:
+            try:
+                os.kill(self.supervisor, signum)
+            except OSError:
+                logger.exception('Failed to signal the master')
+
+    def on_reload_signal(self):
+        logger.info('Got SIGHUP, reloading')
+        asyncio.Task(self.reload())
+
+    def on_update_signal(self):
+        logger.info('Got SIGUSR1, updating')
+        asyncio.Task(self.update())
+
+    def catch_up(self):
+        """
+        Load what changed in the index files (and their logs) since the
+        correctors loaded them, at once. supervise runs it before forking
+        a worker, so the worker does not start from an index the others
+        have reloaded since.
+        """
+        for filename in self.watched_files():
+            # the worker watches the changes made after these
+            self.watch_mtimes[filename] = self.index_mtime(filename)
+            try:
+                self.watch_log_sizes[filename] = os.path.getsize(
+                    log_path(filename))
+            except OSError:
+                self.watch_log_sizes[filename] = 0
+        for corrector in self.correctors():
+            if corrector.index.delta is None:
+                # an index of the marshal format has no log
+                continue
+            try:
+                index = corrector.load_update()
+            except Exception:
+                logger.exception('Failed to reload {}'
+                                 .format(corrector.filename))
+                continue
+            if index is not corrector.index:
+                corrector.install(index)
+                logger.info('Reloaded {} for the next workers'
+                            .format(corrector.filename))
+
+    def index_mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def watched_files(self):
+        # all the hosted indexes, the pool processes may have loaded them
+        if self.indexes is not None:
+            return self.indexes.paths()
+        return [self.corrector.filename]
+
+    def watch(self):
+        changed = updated = False
+        for filename in self.watched_files():
+            mtime = self.index_mtime(filename)
+            if mtime is not None and mtime != self.watch_mtimes.get(filename):
+                if filename in self.watch_mtimes:
+                    logger.info('{} changed, reloading'.format(filename))
+                    changed = True
+                self.watch_mtimes[filename] = mtime
+            try:
+                log_size = os.path.getsize(log_path(filename))
+            except OSError:
+                log_size = 0
+            if log_size != self.watch_log_sizes.get(filename):
+                if filename in self.watch_log_sizes and log_size:
+                    updated = True
+                self.watch_log_sizes[filename] = log_size
+        # a reload reads the log too
+        if changed:
+            asyncio.Task(self.reload())
+        elif updated:
+            asyncio.Task(self.update())
+        self.loop.call_later(self.watch_interval, self.watch)
+
+    def split_deadline(self, query):
+        # the deadline of "@<ms> <query>", it starts when it is read
+        budget = self.deadline
+        if query.startswith('@'):
+            ms, _, rest = query[1:].partition(' ')
+            if ms.isdigit():
+                budget, query = int(ms), rest
+        if not budget:
+            return None, query
+        return Deadline(budget / 1000.0), query
+
+    def split_index(self, query):
+        # the index of "<command> <index> ..." of a correction, with indexes
+        command, _, rest = query.partition(' ')
+        if self.indexes is None or command not in CORRECTIONS:
+            return None, query
+        index, _, rest = rest.partition(' ')
+        return index, '{} {}'.format(command, rest) if rest else command
+
+    @asyncio.coroutine
+    def execute(self, query, phrases=None, deadline=None, index=None):
+        start = default_timer()
+        command = query.split(' ', 1)[0]
+        if command not in COMMANDS:
+            command = 'UNKNOWN'
+        try:
+            result = yield From(self.run_command(query, phrases, deadline,
+                                                 index))
+        except Exception:
+            logger.exception('Failed to execute {!r}'.format(query))
+            result = 'ERROR'
+
+        metrics = self.metrics
+        metrics.counter('typo_requests_total', 'Requests by command',
+                        command=command).inc()
+        # corrections are lowercase, so the prefix is not one of them
+        if deadline is not None and PARTIAL in result:
+            metrics.counter('typo_partial_total',
+                            'Requests cut short by the deadline',
+                            command=command).inc()
+        if result == 'ERROR':
+            metrics.counter('typo_errors_total', 'Failed requests by command',
+                            command=command).inc()
+        metrics.histogram('typo_request_seconds', 'Time to execute a request',
+                          command=command).observe(default_timer() - start)
+        raise asyncio.Return(result)
+
+    @asyncio.coroutine
+    def run_command(self, query, phrases=None, deadline=None, index=None):
+        cmd = query.split(' ', 1)
+        if cmd[0] == 'STATS':
+            result = json.dumps(self.metrics.snapshot(), sort_keys=True)
+        elif cmd[0] == 'RELOAD':
+            self.signal_supervisor(signal.SIGHUP)
+            is_success = yield From(self.reload())
+            result = 'DONE' if is_success else 'ERROR'
+        elif cmd[0] == 'UPDATE':
+            self.signal_supervisor(signal.SIGUSR1)
+            is_success = yield From(self.update())
+            result = 'DONE' if is_success else 'ERROR'
+        elif cmd[0] in CORRECTIONS:
+            result = yield From(self.correct(query, phrases, deadline, index))
+        else:
+            result = 'ERROR'
+        raise asyncio.Return(result)
+
+    @asyncio.coroutine
+    def correct(self, query, phrases=None, deadline=None, index=None):
+        corrector = self.corrector
+        if self.indexes is not None:
+            if index not in self.indexes:
+                raise asyncio.Return('ERROR')
+            if self.pool is None:
+                corrector = self.indexes.get(index)
+            else:
+                # the pool processes load the indexes they are asked for
+                self.indexes.requested(index)
+        if self.pool is None:
+            raise asyncio.Return(run_correction(corrector, query, phrases,
+                                                deadline))
+        if self.queued >= self.queue_limit:
+            self.metrics.counter('typo_busy_total',
+                                 'Corrections rejected by a full queue').inc()
+            raise asyncio.Return('BUSY')
+        self.queued += 1
+        pool = self.pool
+        try:
+            result = yield From(self.loop.run_in_executor(
+                pool, pool_run_correction, query, phrases, deadline, index))
+        except Exception:
+            # a pool process died, the pool does not take new work
+            if pool is self.pool:
+                logger.exception('The pool failed, forking a new one')
+                self.start_pool()
+            raise
+        finally:
+            self.queued -= 1
+        raise asyncio.Return(result)
+
+    def start_pool(self):
+        global pool_corrector, pool_indexes
+        pool_corrector = self.corrector
+        pool_indexes = self.indexes
+        old, self.pool = self.pool, ProcessPoolExecutor(self.pool_size)
+        # fork the processes now, with the index loaded at the moment
+        self.pool.submit(os.getpid)
+        if old is not None:
+            # let the old processes finish what they have got
+            old.shutdown(wait=False)
+
     @asyncio.coroutine
     def process(self, client):
         query = (yield From(asyncio.wait_for(client.reader.readline(),
@@ -58,36 +497,233 @@ class TypedServer(object):
             return
         query = query.strip()
         client_ip = self.client_ip(client)
-        cmd = query.split(' ', 1)
-        if cmd[0] == 'RELOAD':
-            self.corrector.reload()
-            result = 'DONE'
-        elif cmd[0] == 'QUERY' and len(cmd) > 1:
-            data = cmd[1]
-            typo = unicode(data, "utf-8")
-
-            corrected, is_success = self.corrector.suggestion(typo)
-            result = corrected.encode('utf-8')
-        else:
-            result = 'ERROR'
+        deadline, command = self.split_deadline(query)
+        index, command = self.split_index(command)
+        phrases = yield From(self.read_batch(client, command, self.timeout))
+        result = yield From(self.execute(command, phrases, deadline, index))
 
         client.writer.write('{}\n'.format(result))
         yield From(client.writer.drain())
         logger.info("{client}:request:{request}:{result}"
                     .format(client=client_ip, request=query, result=result))
 
-    def start(self, loop):
-        server = asyncio.streams.start_server(
-            self.on_connect, self.listen_host, self.listen_port, loop=loop
-        )
+    @asyncio.coroutine
+    def process_pipeline(self, client):
+        client_ip = self.client_ip(client)
+        inflight = set()
+        ordered = deque()
+
+        def reply(request_id, request, result):
+            if request_id is not None:
+                result = '\n'.join('#{} {}'.format(request_id, line)
+                                   for line in result.split('\n'))
+            client.writer.write('{}\n'.format(result))
+            logger.info("{client}:request:{request}:{result}"
+                        .format(client=client_ip, request=request,
+                                result=result))
+
+        def on_done(task):
+            inflight.discard(task)
+            if task.request_id is not None:
+                reply(task.request_id, task.request, task.result())
+                return
+            # replies without an id leave in the order of the requests
+            while ordered and ordered[0].done():
+                done = ordered.popleft()
+                reply(None, done.request, done.result())
+
+        while True:
+            if len(inflight) >= self.max_inflight:
+                yield From(asyncio.wait(inflight,
+                                        return_when=asyncio.FIRST_COMPLETED))
+                continue
+            yield From(client.writer.drain())
+            try:
+                line = yield From(asyncio.wait_for(client.reader.readline(),
+                                                   timeout=self.idle_timeout))
+            except asyncio.TimeoutError:
+                logger.debug("{client}:idle".format(client=client_ip))
+                break
+            if not line:
+                break
+            request = line.strip()
+            if not request:
+                continue
+            request_id = None
+            query = request
+            if request.startswith('#'):
+                request_id, _, query = request[1:].partition(' ')
+            deadline, query = self.split_deadline(query)
+            index, query = self.split_index(query)
+
+            try:
+                phrases = yield From(self.read_batch(client, query,
+                                                     self.idle_timeout))
+            except asyncio.TimeoutError:
+                break
+
+            task = asyncio.Task(self.execute(query, phrases, deadline, index))
+            task.request_id = request_id
+            task.request = request
+            inflight.add(task)
+            if request_id is None:
+                ordered.append(task)
+            task.add_done_callback(on_done)
+
+        if inflight:
+            yield From(asyncio.wait(inflight))
+        yield From(client.writer.drain())
+
+    def start(self, loop, sock=None):
+        if sock is not None:
+            server = asyncio.streams.start_server(
+                self.on_connect, sock=sock, loop=loop
+            )
+        else:
+            server = asyncio.streams.start_server(
+                self.on_connect, self.listen_host, self.listen_port, loop=loop
+            )
         self.loop = loop
         self.server = loop.run_until_complete(server)
+        if self.pool_size:
+            self.start_pool()
+        loop.add_signal_handler(signal.SIGHUP, self.on_reload_signal)
+        loop.add_signal_handler(signal.SIGUSR1, self.on_update_signal)
+        if self.watch_interval:
+            self.watch()
 
     def stop(self, loop):
         if self.server is not None:
             self.server.close()
             loop.run_until_complete(self.server.wait_closed())
             self.server = None
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def listen(host, port, backlog=100):
+    family, type_, proto, _, address = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def fork_worker(server, sock):
+    pid = os.fork()
+    if pid:
+        return pid
+    # the worker gets a copy-on-write copy of the loaded corrector
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server.start(loop, sock=sock)
+        logger.info('Worker {} is ready'.format(os.getpid()))
+        loop.run_forever()
+    finally:
+        os._exit(1)
+
+
+def supervise(server, sock, workers, restart_delay=1.0):
+    """
+    Fork workers sharing the socket and restart the ones that exit.
+    SIGHUP and SIGUSR1 (sent by RELOAD and UPDATE of a worker) are
+    forwarded to the workers. The index is reloaded by the master too
+    (see TypedServer.catch_up) after them and before a worker is forked.
+    """
+    children = {}
+    stopping = []
+    forwarded = []
+    master = os.getpid()
+    server.supervisor = master
+
+    def spawn():
+        server.catch_up()
+        children[fork_worker(server, sock)] = time.time()
+
+    def stop(signum, frame):
+        if os.getpid() != master:
+            # a worker signalled before it reset the handlers
+            os._exit(1)
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def forward(signum, frame):
+        if os.getpid() != master:
+            return
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+        forwarded.append(signum)
+
+    # the handlers are there before the first fork, a signal does not
+    # leave the workers forked by then running
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # every worker reloads (or updates) its own copy of the index
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGUSR1, forward)
+    for _ in range(workers):
+        if not stopping:
+            spawn()
+
+    while children:
+        if forwarded and not stopping:
+            del forwarded[:]
+            server.catch_up()
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logger.warning('Worker {} exited with status {}, restarting'
+                       .format(pid, status))
+        # do not spin when a worker dies right after start
+        if time.time() - started < restart_delay:
+            time.sleep(restart_delay)
+        spawn()
+
+
+def make_correctors(ctx, index_specs, index_memory, **options):
+    """
+    (corrector of --corrector-index, None) or (None, indexes) of the
+    --index options, index_memory is in MB
+    """
+    corrector_cls = ctx.obj['corrector']
+    if not index_specs:
+        return corrector_cls(ctx.obj['corrector_index'], **options), None
+    try:
+        specs = [parse_index(spec) for spec in index_specs]
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--index')
+    names = [name for name, path, lang in specs]
+    if len(set(names)) != len(names):
+        raise click.BadParameter('an index is named twice',
+                                 param_hint='--index')
+    for name, path, lang in specs:
+        if not os.path.exists(path):
+            raise click.BadParameter('no such index: {}'.format(path),
+                                     param_hint='--index')
+    return None, Indexes(specs, corrector_cls, memory_limit=index_memory << 20,
+                         **options)
 
 
 @click.group()
@@ -101,17 +737,77 @@ def server_group():
               required=True)
 @click.option('--timeout', type=click.IntRange(1, 5000), default=1000,
               required=True)
+@click.option('--cache-size', type=click.IntRange(0, None), default=0,
+              help='Number of cached words, 0 disables the cache')
+@click.option('--engine', type=click.Choice(sorted(ENGINES)),
+              help='Scan the corpus with it rather than look the words '
+                   'up in the deletion index of the index')
+@click.option('--engine-memory', type=click.IntRange(0, None), default=0,
+              help='Memory for the first letters kept by the engine (MB), '
+                   'the least recently used ones are dropped beyond it, '
+                   '0 does not limit it')
+@click.option('--max-candidates', type=click.IntRange(1, None), default=1,
+              help='Candidates of a word, TOP combines them')
+@click.option('--workers', type=click.IntRange(1, None), default=1,
+              help='Number of processes accepting on the port')
+@click.option('--keepalive', is_flag=True, default=False,
+              help='Keep connections open for pipelined requests')
+@click.option('--idle-timeout', type=click.IntRange(1, None), default=60000,
+              help='Close idle keepalive connections after it (ms)')
+@click.option('--max-inflight', type=click.IntRange(1, None), default=64,
+              help='Requests of a keepalive connection served at once')
+@click.option('--watch', type=click.IntRange(0, None), default=0,
+              help='Reload the index when its file changes, checked '
+                   'every N seconds, 0 disables it')
+@click.option('--pool-size', type=click.IntRange(0, None), default=0,
+              help='Processes correcting queries off the event loop (per '
+                   'worker), 0 corrects them in the loop')
+@click.option('--queue-limit', type=click.IntRange(1, None), default=256,
+              help='Queries waiting or running in the pool, the next '
+                   'ones are answered BUSY')
+@click.option('--deadline', type=click.IntRange(0, None), default=0,
+              help='Time the search for a correction may take (ms), the '
+                   'best found by then is answered PARTIAL, 0 disables it')
+@click.option('--index', 'index_specs', multiple=True,
+              help='NAME=PATH[:LANG] of an index to host instead of '
+                   '--corrector-index, corrections name it')
+@click.option('--index-memory', type=click.IntRange(0, None), default=0,
+              help='Memory for the hosted indexes (MB), the least recently '
+                   'used ones are dropped beyond it, 0 does not limit it')
 @click.pass_context
-def server(ctx, host, port, timeout):
+def server(ctx, host, port, timeout, cache_size, engine, engine_memory,
+           max_candidates, workers, keepalive, idle_timeout, max_inflight,
+           watch, pool_size, queue_limit, deadline, index_specs,
+           index_memory):
     """Typod server"""
 
-    corrector_index = ctx.obj['corrector_index']
     corrector_cls = ctx.obj['corrector']
-    inst = corrector_cls(corrector_index)
+    inst, indexes = make_correctors(ctx, index_specs, index_memory,
+                                    cache_size=cache_size, engine=engine,
+                                    engine_memory=engine_memory << 20,
+                                    max_candidates=max_candidates)
     server = TypedServer(host=host,
                          port=port,
                          timeout=timeout,
-                         corrector=inst)
+                         corrector=inst,
+                         keepalive=keepalive,
+                         idle_timeout=idle_timeout,
+                         max_inflight=max_inflight,
+                         watch_interval=watch,
+                         pool_size=pool_size,
+                         queue_limit=queue_limit,
+                         deadline=deadline,
+                         indexes=indexes)
+
+    if workers > 1:
+        logger.info('Run server on {}:{}, using {} corrector, {} workers'
+                    .format(host, port, corrector_cls.typo_name, workers))
+        sock = listen(host, port)
+        try:
+            supervise(server, sock, workers)
+        finally:
+            sock.close()
+        return
 
     loop = asyncio.get_event_loop()
     logger.info('Run server on {}:{}, using {} corrector'
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Bigram model of a phrase corpus. A pair of words scores how much likelier
+the right word is after the left one than anywhere, the candidates of
+neighbouring words of a phrase are reranked by it.
+"""
+import logging
+import math
+import re
+import struct
+from array import array
+from itertools import groupby
+
+import storage
+from utils import MIN_WEIGHT
+
+logger = logging.getLogger(__name__)
+
+SCORE_STEP = 0.1  # nats, a quantized score is an int8 of them
+MIN_PAIR_COUNT = 2
+
+PAIR = struct.Struct('>II')  # bytes of (left, right) sort as the pair
+PUNCTUATION = re.compile(r'[^\w\s]+', re.UNICODE)
+
+
+def clauses(line):
+    """ Lowercase words of a line, a list per run not broken by punctuation """
+    for clause in PUNCTUATION.split(line.lower()):
+        words = clause.split()
+        if words:
+            yield words
+
+
+def count_bigrams(words, phrases, memory_limit, tmp_dir=None,
+                  min_count=MIN_PAIR_COUNT):
+    """
+    Yield (left id, right id, quantized score) sorted by ids of the pairs
+    of known words seen min_count times in phrases, an iterable of lines.
+    Only pairs seen more often than by chance are kept: candidates of a
+    distance are ordered by weight, a pair promotes one of them.
+    """
+    unigrams = array('I', [0]) * len(words)
+    total = 0
+    pairs = storage.ExternalSorter(memory_limit, tmp_dir)
+    for line in phrases:
+        for clause in clauses(line):
+            previous = -1
+            for word in clause:
+                i = words.find(word.encode('utf-8'))
+                if i >= 0:
+                    unigrams[i] += 1
+                    total += 1
+                    if previous >= 0:
+                        pairs.add((PAIR.pack(previous, i),))
+                previous = i
+
+    for (key,), group in groupby(pairs):
+        count = sum(1 for _ in group)
+        if count < min_count:
+            continue
+        left, right = PAIR.unpack(key)
+        score = math.log(float(count) * total / unigrams[left] / unigrams[right])
+        score = min(127, int(round(score / SCORE_STEP)))
+        if score > 0:
+            yield left, right, score
+
+
+def runs(chunks):
+    """ Lists of the positions of words separated by spaces only """
+    run = []
+    for i, (chunk, mode) in enumerate(chunks):
+        if mode and mode != 2:
+            run.append(i)
+        elif mode or not chunk.isspace():
+            # a number or punctuation
+            if len(run) > 1:
+                yield run
+            run = []
+    if len(run) > 1:
+        yield run
+
+
+def rerank(chunks, suggestions, bigrams, words):
+    """
+    Put first the candidates of the best sequence of every run of words
+    (Viterbi): the sum of the log weights of the candidates and the scores
+    of the pairs of neighbours. The other candidates keep their order.
+    """
+    def ends(cword):
+        # ids of the first and the last word of a candidate, or -1
+        tokens = cword.split()
+        if not tokens:
+            return -1, -1
+        return (words.find(tokens[0].encode('utf-8')),
+                words.find(tokens[-1].encode('utf-8')))
+
+    for run in runs(chunks):
+        layers = [suggestions[i] for i in run]
+        if all(len(layer) == 1 for layer in layers):
+            continue
+
+        layer_ends = [[ends(cword) for cword, _ in layer] for layer in layers]
+        # (score, back pointer) of the best sequence ending in a candidate
+        best = [(math.log(max(weight, MIN_WEIGHT)), None)
+                for _, weight in layers[0]]
+        back = []
+        for k in range(1, len(layers)):
+            current = []
+            for j, (_, weight) in enumerate(layers[k]):
+                first = layer_ends[k][j][0]
+                scores = []
+                for i, (score, _) in enumerate(best):
+                    last = layer_ends[k - 1][i][1]
+                    if last >= 0 and first >= 0:
+                        score += bigrams.score(last, first)
+                    scores.append((score, -i))
+                score, i = max(scores)
+                current.append((score + math.log(max(weight, MIN_WEIGHT)), -i))
+            back.append([previous for _, previous in current])
+            best = current
+
+        j = max(range(len(best)), key=lambda j: (best[j][0], -j))
+        for k in range(len(layers) - 1, -1, -1):
+            layer = layers[k]
+            layer.insert(0, layer.pop(j))
+            if k:
+                j = back[k - 1][j]
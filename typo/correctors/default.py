@@ -1,39 +1,278 @@
 # -*- coding: utf-8 -*-
 import logging
-from collections import defaultdict, namedtuple
+import os
+import time
+import zlib
+from collections import defaultdict
 
 import Levenshtein
 import marshal
-from utils import register_typo
+import storage
+from concurrent.futures import ProcessPoolExecutor
+from bigrams import MIN_PAIR_COUNT, SCORE_STEP, count_bigrams, rerank
+from delta import Delta, append_log, changed_items, log_path, read_log
+from engines import ENGINES
+from utils import register_typo, best_phrases, LRUCache, WordTuple
 from functools import partial
+from itertools import chain, groupby
+from operator import attrgetter, itemgetter
 
 logger = logging.getLogger(__name__)
 
 ONE_LETTER_IN_LAST_WORD = False # XXX make configurable
+DELETES_DISTANCE = 2  # max distance covered by the deletion index
+# the words of a dictionary that small are held in memory, its corpus
+# is scanned faster than its deletion index is probed
+SCAN_WORDS = storage.MEMORY_WORDS
+CONVERT_MEMORY_LIMIT = 512 << 20
 
 GOOD_PARTICLES = {
     'ru': {u'у', u'к', u'а', u'а', u'о', u'я', u'с', u'и'},
     'en': {u'a', 'i'},
     }
 
+# the keys of a layout in the order of the keys of the others, the
+# shifted symbols of the letters of the Russian layout last
+LAYOUT_KEYS = {
+    'en': u"`qwertyuiop[]asdfghjkl;'zxcvbnm,." + u'~{}:"<>',
+    'ru': u'ёйцукенгшщзхъфывапролджэячсмитьбю' + u'ёхъжэбю',
+}
+
+
+def layout_table(source, target):
+    # unicode.translate table of the keys of source to those of target
+    table = {}
+    for key, target_key in zip(LAYOUT_KEYS[source], LAYOUT_KEYS[target]):
+        table.setdefault(ord(key), target_key)
+    return table
+
+
+# layouts a phrase of a lang may have been typed in by mistake
+LAYOUTS = {
+    'ru': (layout_table('en', 'ru'), layout_table('ru', 'en')),
+    'en': (layout_table('ru', 'en'),),
+}
+
+
+def deletion_levels(word, distance, deadline=None):
+    """
+    Yield the strings made of word by deleting 0, 1, ... distance letters,
+    the levels stop when the deadline is over, a long word has a lot of them
+    """
+    edge = {word}
+    yield edge
+    for _ in range(distance):
+        level = set()
+        for w in edge:
+            if deadline is not None and deadline.exceeded():
+                return
+            level.update([w[:i] + w[i + 1:] for i in range(len(w))])
+        edge = level
+        yield edge
+
+
+def deletions(word, distance):
+    """ All the strings made of word by deleting up to distance letters """
+    return set().union(*deletion_levels(word, distance))
+
+
+def posting_keys(word, deletes_distance=DELETES_DISTANCE):
+    """ {posting table: keys listing word}, see TypoDefault.convert """
+    reverse = set()
+    if len(word) > 1:
+        reverse.update([word[1:], word[:1] + word[2:]])
+    # two words with the same first letter are within distance d
+    # iff their tails have a common deletion of at most d letters
+    deletes = set(word[:1] + deletion
+                  for deletion in deletions(word[1:], deletes_distance))
+    return {'reverse': reverse, 'deletes': deletes}
+
+
+def shard_of(key, shards):
+    """
+    The shard of shards owning the posting keys starting with the first
+    letter of key and the corpus of that letter, see TypoDefault.convert
+    """
+    return (zlib.crc32(key[:1].encode('utf-8')) & 0xffffffff) % shards
+
+
+def owned(key, shard):
+    # shard is (i, shards) of a shard index, None owns every key
+    return shard is None or shard_of(key, shard[1]) == shard[0]
+
+
+def grouped_postings(pairs):
+    # sorted (key, id) pairs -> (key, [id, ...])
+    return ((key, [i for _, i in group])
+            for key, group in groupby(pairs, itemgetter(0)))
+
+
+def build_postings(start, words, memory_limit, tmp_dir, shard=None):
+    """
+    The postings of words sharing a first letter, their ids from start:
+    the deletes table of them, its keys are all the keys starting with
+    the letter, and a dump of the sorted reverse (key, id) pairs. Run in
+    the pool of TypoDefault.convert, only the keys of shard are kept.
+    """
+    reverse = storage.ExternalSorter(memory_limit, tmp_dir)
+    deletes = storage.ExternalSorter(memory_limit, tmp_dir)
+    for i, word in enumerate(words, start):
+        keys = posting_keys(word)
+        for posting in keys['reverse']:
+            if owned(posting, shard):
+                reverse.add((posting.encode('utf-8'), i))
+        for posting in keys['deletes']:
+            if owned(posting, shard):
+                deletes.add((posting.encode('utf-8'), i))
+    part = storage.write_postings_part(grouped_postings(deletes), tmp_dir)
+    try:
+        return part, reverse.dump()
+    except Exception:
+        os.unlink(part.path)
+        raise
+
+
+def file_id(filename):
+    # a compaction replaces the index file
+    stat = os.stat(filename)
+    return stat.st_dev, stat.st_ino, stat.st_mtime
+
+
+class IndexSnapshot(object):
+    """ The tables of a loaded index, replaced as a whole by reload """
+    # indexes built before the deletion index or the trie was added
+    # do not have them, bigrams are built from a phrase corpus only
+    deletes = None
+    deletes_distance = 0
+    words = None
+    trie = None
+    bigrams = None
+    # (i, shards) of a shard index, see TypoDefault.convert
+    shard = None
+    # the tables of the index file, the delta of its log on top of them
+    # and the end of the log read, marshal indexes do not have a log
+    base = None
+    base_id = None
+    delta = None
+    log_offset = 0
+
+    def __init__(self, attributes, load_time):
+        self.load_time = load_time
+        for (key, item) in attributes.items():
+            setattr(self, key, item)
+
+
+def index_attribute(name):
+    return property(attrgetter('index.' + name))
+
 
 @register_typo
 class TypoDefault(object):
     """ Bases on levenshtein_simple.py """
     typo_name = 'default'
     max_candidates = 1
-
-    def __init__(self, index, max_candidates=1, lang='ru'):
+    scan_words = SCAN_WORDS
+
+    good_words = index_attribute('good_words')
+    reverse = index_attribute('reverse')
+    weights = index_attribute('weights')
+    words = index_attribute('words')
+    corpus = index_attribute('corpus')
+    deletes = index_attribute('deletes')
+    deletes_distance = index_attribute('deletes_distance')
+    trie = index_attribute('trie')
+    bigrams = index_attribute('bigrams')
+    engine = index_attribute('engine')
+    shard = index_attribute('shard')
+
+    def __init__(self, index, max_candidates=1, lang='ru', cache_size=0,
+                 engine=None, engine_memory=0):
         self.filename = index
+        # how the corpus is scanned, see engines, engine_memory bounds
+        # the bytes of the first letters it keeps, 0 does not. Without
+        # an engine the words are looked up in the deletion index, the
+        # corpus is scanned by the python engine for the indexes (or the
+        # distances) it does not cover and for the small ones
+        self.engine_cls = ENGINES[engine or 'python']
+        self.engine_memory = engine_memory
+        self.scan_corpus = engine is not None
+        # results of find_candidates, cache_size=0 disables it
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
         self.reload()
         self.max_candidates = max_candidates
         self.lang = lang
         self.good_particles = GOOD_PARTICLES.get(self.lang, [])
+        self.layouts = LAYOUTS.get(self.lang, ())
+
+    def load(self):
+        # load good_words, reverse, weights, corpus without touching self,
+        # so it can be run in another thread while self keeps serving
+        start = time.time()
+        if not storage.is_index(self.filename):
+            # an index written before the mmap format, see TypoDefault.dump
+            attributes = marshal.loads(open(self.filename).read())
+            if os.path.exists(log_path(self.filename)):
+                logger.warning('{} is not applied, convert the index again '
+                               'to update it'.format(log_path(self.filename)))
+            return self.snapshot(attributes, None, start)
+
+        base_id = file_id(self.filename)
+        attributes = storage.IndexFile(self.filename).attributes()
+        keys = partial(posting_keys,
+                       deletes_distance=attributes.get('deletes_distance', 0))
+        delta = Delta(attributes['words'], keys)
+        records, offset = read_log(self.filename)
+        delta.apply(records)
+        index = self.snapshot(attributes, delta, start, offset)
+        index.base_id = base_id
+        return index
+
+    def load_update(self, index=None):
+        """
+        The index with the records appended to its log since it was
+        loaded put on top of it, index itself if there are none. The
+        index is loaded again when it was compacted since. Like load it
+        can be run in another thread.
+        """
+        start = time.time()
+        index = self.index if index is None else index
+        if index.delta is None:
+            raise RuntimeError('{} is not in the mmap format, convert it '
+                               'again to update it'.format(self.filename))
+        log = log_path(self.filename)
+        log_size = os.path.getsize(log) if os.path.exists(log) else 0
+        if file_id(self.filename) != index.base_id or \
+                log_size < index.log_offset:
+            return self.load()
+        records, offset = read_log(self.filename, index.log_offset)
+        if not records:
+            return index
+        delta = index.delta.copy()
+        delta.apply(records)
+        result = self.snapshot(index.base, delta, start, offset)
+        result.base_id = index.base_id
+        return result
+
+    def snapshot(self, base, delta, start, log_offset=0):
+        # the tables of an index file and the delta of its log
+        attributes = delta.overlay(base) if delta else base
+        index = IndexSnapshot(attributes, time.time() - start)
+        index.base = base
+        index.delta = delta
+        index.log_offset = log_offset
+        index.engine = self.engine_cls(index, self.engine_memory)
+        index.scan_corpus = self.scan_corpus or index.deletes is None or \
+            len(index.words) <= self.scan_words
+        return index
+
+    def install(self, index):
+        # a single assignment, requests see either the old or the new index
+        self.index = index
+        if self.cache is not None:
+            self.cache.clear()
 
     def reload(self):
-        # load self.good_words, self.reverse, self.weights, self.corpus from marshal
-        for (key, item) in marshal.loads(open(self.filename).read()).items():
-            setattr(self, key, item)
+        self.install(self.load())
 
     def calc_cweight(self, d, skip, w, word):
         if skip < d: return 0
@@ -62,17 +301,73 @@ class TypoDefault(object):
                 cweight = self.calc_cweight(d, skip_distance, weight, word)
                 candidates[d].append((cword, cweight))
 
-    def return_as_is(self, word):
-        return [(word, 1)]
-
-    def find_candidates(self, word, max_candidates=3, skip_distance=3, is_last=False):
-        skip_distance = max(min(skip_distance, len(word) // 2), 1)
-
-        candidates = defaultdict(list)
+    def handle_glued(self, word, candidates, skip_distance, is_last):
+        if self.trie is None:
+            return self.handle_glued_pairs(word, candidates, skip_distance, is_last)
+
+        n = len(word)
+        digits = [0] * (n + 1)  # end of the run of digits starting at i
+        for i in range(n - 1, -1, -1):
+            if word[i].isdigit():
+                digits[i] = digits[i + 1] or i + 1
+
+        def segments(i):
+            # words and numbers starting at i, the whole word is not one
+            ends = [(end, self.words.weight(w))
+                    for end, w in self.trie.prefixes(word, i)]
+            if digits[i]:
+                numbers = dict((end, 0) for end in range(i + 1, digits[i] + 1))
+                numbers.update(ends)
+                ends = sorted(numbers.items())
+            result = []
+            for end, weight in ends:
+                if i == 0 and end == n:
+                    continue
+                if end - i == 1 and self.ignore_candidate(is_last and end == n,
+                                                          word, word[i]):
+                    continue
+                result.append((end, weight))
+            return result
+
+        # best[i] is (words, sum of weights, start of the last word) of
+        # the split of word[:i] into the least words of the most weight
+        best = [None] * (n + 1)
+        best[0] = (0, 0, None)
+        found = {}
+        for i in range(n):
+            if best[i] is None:
+                continue
+            found[i] = segments(i)
+            words, weight = best[i][:2]
+            for end, w in found[i]:
+                split = (words + 1, weight + w, i)
+                if best[end] is None or (split[0], -split[1]) < (best[end][0], -best[end][1]):
+                    best[end] = split
 
-        if word in self.good_words:
-            return self.return_as_is(word)
+        # check if two words are sticked together
+        for i, weight_prefix in found.get(0, []):
+            for end, weight_postfix in found.get(i, []):
+                if end == n:
+                    weight = (weight_prefix + weight_postfix) / 2
+                    cword = " ".join([word[:i], word[i:]])
+                    cweight = self.calc_cweight(1, skip_distance, weight, word)
+                    candidates[1].append((cword, cweight))
 
+        # or more of them, every space is an edit; it is returned to be
+        # used only if nothing closer is found
+        if best[n] is not None and 2 < best[n][0] <= skip_distance + 1:
+            parts = []
+            end = n
+            while end:
+                start = best[end][2]
+                parts.append(word[start:end])
+                end = start
+            d = len(parts) - 1
+            weight = best[n][1] / len(parts)
+            cweight = self.calc_cweight(d, skip_distance, weight, word)
+            return d, (" ".join(reversed(parts)), cweight)
+
+    def handle_glued_pairs(self, word, candidates, skip_distance, is_last):
         _ignore_candidate = partial(self.ignore_candidate, is_last, word)
 
         # check if two words are sticked together
@@ -91,32 +386,138 @@ class TypoDefault(object):
                     cweight = self.calc_cweight(1, skip_distance, weight, word)
                     candidates[1].append((cword, cweight))
 
-        # handle the first letter
-        # absent
-        self.handle_reverse(word, word, candidates, skip_distance)
+    def handle_deletes(self, word, candidates, skip_distance, max_candidates=None,
+                       deadline=None):
+        # words with the same first letter share it in the deletion key, so
+        # only the rest of the word is reduced, see TypoDefault.convert
+        first, rest = word[:1], word[1:]
+        seen = set()
+        for level, keys in enumerate(deletion_levels(rest, skip_distance,
+                                                     deadline)):
+            for deletion in keys:
+                key = first + deletion
+                if key not in self.deletes:
+                    continue
+                for cword, weight in self.deletes[key]:
+                    if cword in seen:
+                        continue
+                    seen.add(cword)
+                    d = Levenshtein.distance(cword, word)
+                    if d > skip_distance:
+                        continue
+                    cweight = self.calc_cweight(d, skip_distance, weight, word)
+                    candidates[d].append((cword, cweight))
+            # the words within distance 1 are all found by the keys of up
+            # to one deletion, with max_candidates of them better_candidates
+            # takes nothing further, the next level is not even made
+            if level and max_candidates is not None and \
+                    len(candidates.get(1, ())) >= max_candidates:
+                break
+
+    def handle_corpus(self, word, candidates, skip_distance, max_candidates=None,
+                      deadline=None):
+        enough = None
+        if max_candidates is not None:
+            enough = max_candidates - len(candidates.get(1, ()))
+        for cword, weight, d in self.engine.scan(word, skip_distance, enough,
+                                                 deadline):
+            cweight = self.calc_cweight(d, skip_distance, weight, word)
+            candidates[d].append((cword, cweight))
+
+    def return_as_is(self, word):
+        return [(word, 1)]
 
-        # changed
+    def find_candidates(self, word, max_candidates=3, skip_distance=3, is_last=False,
+                        deadline=None):
+        # cheapest first: with a deadline the steps after it is over are
+        # skipped and the candidates found so far are returned
+        skip_distance = max(min(skip_distance, len(word) // 2), 1)
+
+        candidates = defaultdict(list)
+
+        if word in self.good_words:
+            return self.return_as_is(word)
+
+        def exceeded():
+            return deadline is not None and deadline.exceeded()
+
+        glued = None
+        if not exceeded():
+            glued = self.handle_glued(word, candidates, skip_distance, is_last)
+
+        if not exceeded():
+            for key, step in self.lookup_steps(word, skip_distance,
+                                               max_candidates, deadline):
+                step(candidates)
+
+        return self.pick_candidates(word, candidates, glued, skip_distance,
+                                    max_candidates, is_last)
+
+    def lookup_steps(self, word, skip_distance, max_candidates=None,
+                     deadline=None):
+        """
+        The lookups of find_candidates in the postings and the corpus, in
+        order, as (key, step): a step adds the candidates it finds to the
+        candidates it is called with. The key tells the shard owning the
+        lookup, see shard_candidates.
+        """
         tail = word[1:]
-        self.handle_reverse(word, tail, candidates, skip_distance)
-        # changed and swiped
-        self.handle_reverse(word, word[:1] + word[2:], candidates, skip_distance)
-        # added
-        if tail in self.good_words:
-            weight = self.weights[tail]
-            cweight = self.calc_cweight(1, skip_distance, weight, word)
-            candidates[1].append((tail, cweight))
-
-        # find all candidates which has distance <= skip_distance
-        key = ord(word[0])
-        if key in self.corpus:
-            for cword, weight in self.corpus[key].items():
-                if abs(len(cword) - len(word)) > skip_distance: # small optimization
-                    continue
-                d = Levenshtein.distance(cword, word)
-                if d > skip_distance:
-                    continue
-                cweight = self.calc_cweight(d, skip_distance, weight, word)
-                candidates[d].append((cword, cweight))
+        swiped = word[:1] + word[2:]
+
+        def reverse(key):
+            return partial(self.handle_reverse, word, key,
+                           skip_distance=skip_distance)
+
+        def added(candidates):
+            if tail in self.good_words:
+                weight = self.weights[tail]
+                cweight = self.calc_cweight(1, skip_distance, weight, word)
+                candidates[1].append((tail, cweight))
+
+        def scan(candidates):
+            # find all candidates which has distance <= skip_distance
+            if deadline is not None and deadline.exceeded():
+                return
+            if not self.index.scan_corpus and \
+                    skip_distance <= self.deletes_distance:
+                self.handle_deletes(word, candidates, skip_distance,
+                                    max_candidates, deadline)
+            else:
+                self.handle_corpus(word, candidates, skip_distance,
+                                   max_candidates, deadline)
+
+        # the first letter absent, changed, changed and swiped, added
+        return [(word, reverse(word)), (tail, reverse(tail)),
+                (swiped, reverse(swiped)), (tail, added), (word, scan)]
+
+    def shard_candidates(self, word, max_candidates=3, skip_distance=3,
+                         deadline=None):
+        """
+        [(step, distance, candidate, weight)] of the lookup_steps of the
+        keys this index owns, in order: a shard index (see convert) has
+        the postings and the corpus of some first letters only, the
+        router (typo.cmd_router) merges those of the shards of a word.
+        """
+        candidates = defaultdict(list)
+        result = []
+        for step, (key, lookup) in enumerate(self.lookup_steps(
+                word, skip_distance, max_candidates, deadline)):
+            if not owned(key, self.shard):
+                continue
+            counts = dict((d, len(found)) for d, found in candidates.items())
+            lookup(candidates)
+            for d, found in sorted(candidates.items()):
+                result.extend((step, d, cword, cweight)
+                              for cword, cweight in found[counts.get(d, 0):])
+        return result
+
+    def pick_candidates(self, word, candidates, glued, skip_distance,
+                        max_candidates, is_last):
+        # the best of the candidates found by distance, the glued words
+        # of handle_glued when there are none
+        _ignore_candidate = partial(self.ignore_candidate, is_last, word)
+        if glued is not None and not candidates:
+            candidates[glued[0]].append(glued[1])
 
         if _ignore_candidate(word) and len(word) == 1:
             cweight = self.calc_cweight(1, skip_distance, 1, word)
@@ -124,6 +525,26 @@ class TypoDefault(object):
 
         return self.better_candidates(candidates, skip_distance, max_candidates, is_last, word)
 
+    def cached_candidates(self, word, max_candidates=3, skip_distance=3, is_last=False,
+                          deadline=None):
+        if self.cache is None:
+            return self.find_candidates(word, max_candidates=max_candidates,
+                                        skip_distance=skip_distance,
+                                        is_last=is_last, deadline=deadline)
+        key = (word, is_last, max_candidates, skip_distance)
+        candidates = self.cache.get(key)
+        if candidates is None:
+            skipped = deadline.skipped if deadline is not None else 0
+            candidates = self.find_candidates(word,
+                                              max_candidates=max_candidates,
+                                              skip_distance=skip_distance,
+                                              is_last=is_last,
+                                              deadline=deadline)
+            # candidates cut short by the deadline are not all of them
+            if deadline is None or deadline.skipped == skipped:
+                self.cache.set(key, candidates)
+        return list(candidates)
+
     def better_candidates(self, candidates, skip_distance, max_candidates, is_last, word):
         if not candidates:
             return []
@@ -139,7 +560,8 @@ class TypoDefault(object):
 
         # return the best
         better_candidates.sort(key=lambda x: x[1], reverse=True)
-        max_weight = better_candidates[0][1]
+        # a candidate at the skip distance weighs 0
+        max_weight = better_candidates[0][1] or 1
         better_candidates = [(cword, cweight * 100.0 / max_weight) for cword, cweight
                              in better_candidates if not _ignore_candidate(cword)]
         return better_candidates[:max_candidates]
@@ -170,8 +592,97 @@ class TypoDefault(object):
             chunks.append((chunk, mode))
         return chunks
 
-    def suggestion(self, phrase):
+    def suggestion(self, phrase, deadline=None):
+        """
+        With a Deadline the words are corrected with the candidates found
+        before it is over, deadline.partial tells if any search was cut.
+        """
+        return self.phrase_suggestion(phrase, self.cached_candidates, deadline)
+
+    def top_phrases(self, phrase, k, deadline=None):
+        """ The k best corrections of phrase and their weights, see best_phrases """
+        suggestions, _ = self.suggestion(phrase, deadline)
+        return best_phrases(suggestions, k)
+
+    def suggestion_many(self, phrases, deadline=None):
+        """
+        Yield suggestion(phrase) for every phrase in order,
+        candidates of a word repeated in the phrases are found once.
+        The phrases share the deadline.
+        """
+        found = {}
+
+        def candidates(word, max_candidates, skip_distance, is_last,
+                       deadline=None):
+            key = (word, is_last, max_candidates, skip_distance)
+            if key not in found:
+                skipped = deadline.skipped if deadline is not None else 0
+                result = self.cached_candidates(
+                    word, max_candidates=max_candidates,
+                    skip_distance=skip_distance, is_last=is_last,
+                    deadline=deadline)
+                if deadline is not None and deadline.skipped != skipped:
+                    return result
+                found[key] = result
+            return list(found[key])
+
+        for phrase in phrases:
+            yield self.phrase_suggestion(phrase, candidates, deadline)
+
+    def is_known(self, chunks):
+        # all the words of the chunks are in the dictionary
+        return all(chunk in self.good_words
+                   for chunk, mode in chunks if mode and mode != 2)
+
+    def layout_suggestion(self, phrase, chunks):
+        """
+        Suggestions of a phrase typed in the wrong keyboard layout
+        ("ghbdtn"): the first translation of it to another layout of lang
+        that is all dictionary words, None if there is none or the phrase
+        is all dictionary words itself. Punctuation ending a word may be
+        the keys of letters or be typed as meant ("ghbdtn, vbh"), a word
+        is not translated to punctuation alone ("бю" is not ",.").
+        """
+        if not self.layouts or self.is_known(chunks):
+            return None
+        tokens = phrase.lower().split(u' ')
+        for table in self.layouts:
+            translated = []
+            for token in tokens:
+                end = len(token)
+                while end and not token[end - 1].isalpha():
+                    end -= 1
+                for option in (token.translate(table),
+                               token[:end].translate(table) + token[end:]):
+                    # a token of letters is a word, the others may be
+                    # glued to punctuation or digits
+                    if option.isalpha():
+                        known = option in self.good_words
+                    else:
+                        words = [chunk for chunk, mode
+                                 in self.split_chunks(option)
+                                 if mode and mode != 2]
+                        # a word has a word in the other layout too
+                        known = (bool(words) or not end) and \
+                            all(word in self.good_words for word in words)
+                    if known:
+                        translated.append(option)
+                        break
+                else:
+                    break
+            else:
+                translated = u' '.join(translated)
+                if translated != phrase.lower():
+                    return [[(chunk, 1)]
+                            for chunk, mode in self.split_chunks(translated)]
+        return None
+
+    def phrase_suggestion(self, phrase, candidates, deadline=None):
         chunks = self.split_chunks(phrase)
+        # the layout is tried first, it takes a lookup per word
+        suggestions = self.layout_suggestion(phrase, chunks)
+        if suggestions is not None:
+            return suggestions, True
         suggestions = []
         suggestion_valid = True
 
@@ -179,10 +690,11 @@ class TypoDefault(object):
             is_last = i == len(chunks) - 1
             if mode and mode != 2:
                 max_candidates = self.max_candidates if len(chunks) > 1 else 1
-                candidate = self.find_candidates(chunk,
-                                                 max_candidates=max_candidates,
-                                                 skip_distance=2,
-                                                 is_last=is_last)
+                candidate = candidates(chunk,
+                                       max_candidates=max_candidates,
+                                       skip_distance=2,
+                                       is_last=is_last,
+                                       deadline=deadline)
                 if candidate:
                     suggestions.append(candidate)
                 else:
@@ -191,43 +703,152 @@ class TypoDefault(object):
             else:
                 suggestions.append([(chunk, 1)])
 
+        if self.bigrams is not None:
+            rerank(chunks, suggestions, self.bigrams, self.words)
         return suggestions, suggestion_valid
 
     @classmethod
-    def convert(cls, items):
-        # return a dict to be dumped as marshal structure
-        # the items of dict will be set as attributes of corrector item
-        corpus = defaultdict(dict, {})
-        reverse = defaultdict(list)
-        reverse_set = defaultdict(set)
-        weights = {}
-        words = []
-        for item in items:
-            word = item.keyword
-            weight = item.hits
-            first_byte = ord(word[0])
-            corpus[first_byte][word] = weight
-            words.append(word)
-
-            weights[word] = weight
-            if len(word) < 2:
-                continue
-
-            tail = word[1:]
-            if word not in reverse_set[tail]:
-                reverse[tail].append((word, weight))
-                reverse_set[tail].add(word)
-
-            tail = word[:1] + word[2:]
-            if word not in reverse_set[tail]:
-                reverse[tail].append((word, weight))
-                reverse_set[tail].add(word)
+    def convert(cls, items, fd, memory_limit=CONVERT_MEMORY_LIMIT, tmp_dir=None,
+                phrases=None, min_pair_count=MIN_PAIR_COUNT, bigrams=None,
+                jobs=1, shard=None):
+        # write the index of items to fd, see storage for the format,
+        # phrases are lines of text to build the bigram model of, or
+        # bigrams is (step, pairs) of the model of another index, pairs
+        # of utf-8 words sorted by their ids there, see Bigrams.pairs
+        # words, the keys of reverse and deletes and the corpus buckets are
+        # sorted in runs spilled to tmp_dir, so the dictionary does not have to fit in memory
+        # with jobs > 1 the postings of every first letter are built by a
+        # pool of that many processes, see build_postings, and put together
+        # in the order of the letters: the index is the same
+        # a shard (i, shards) keeps all the words, their trie and bigrams,
+        # and the posting keys and corpus of the first letters it owns
+        # only, see shard_of
+        memory_limit //= 4
+        words = storage.ExternalSorter(memory_limit, tmp_dir)
+        for seq, item in enumerate(items):
+            words.add((item.keyword.encode('utf-8'), seq, item.hits))
+
+        postings = {
+            'reverse': storage.ExternalSorter(memory_limit, tmp_dir),
+            'deletes': storage.ExternalSorter(memory_limit, tmp_dir),
+        }
+        buckets = storage.ExternalSorter(memory_limit, tmp_dir)
+        trie = storage.TrieBuilder(tmp_dir)
+        pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+        parts = []  # futures of build_postings of the letters, in order
+
+        def unique_words():
+            # the hits of the last occurrence of a word win, postings
+            # refer to words by their position in the sorted word table
+            letter = []  # words of the last first letter
+            for i, (key, group) in enumerate(groupby(words, itemgetter(0))):
+                weight = list(group)[-1][2]
+                word = key.decode('utf-8')
+                trie.add(word, i)
+                if owned(word, shard):
+                    buckets.add((word[:1].encode('utf-8'), len(word), i))
+                if pool is None:
+                    for name, keys in posting_keys(word).items():
+                        for posting in keys:
+                            if owned(posting, shard):
+                                postings[name].add((posting.encode('utf-8'),
+                                                    i))
+                else:
+                    # the words of a letter are next to each other
+                    if letter and letter[0][:1] != word[:1]:
+                        parts.append(pool.submit(
+                            build_postings, i - len(letter), letter,
+                            memory_limit // jobs, tmp_dir, shard))
+                        letter = []
+                    letter.append(word)
+                yield key, min(weight, storage.MAX_WEIGHT)
+            if letter:
+                parts.append(pool.submit(
+                    build_postings, i + 1 - len(letter), letter,
+                    memory_limit // jobs, tmp_dir, shard))
+
+        writer = storage.IndexWriter(fd, tmp_dir)
+        try:
+            writer.add_words(unique_words())
+            writer.add_trie(trie)
+            writer.add_buckets(buckets)
+            if pool is None:
+                for name in ('reverse', 'deletes'):
+                    writer.add_postings(name, grouped_postings(postings[name]))
+            else:
+                results = [part.result() for part in parts]
+                for _, reverse in results:
+                    postings['reverse'].load(reverse)
+                writer.add_postings('reverse',
+                                    grouped_postings(postings['reverse']))
+                writer.add_postings_parts('deletes',
+                                          [part for part, _ in results])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+                for part in parts:
+                    # the files of the letters left by a failure
+                    if part.exception() is None:
+                        deletes, reverse = part.result()
+                        for path in (deletes.path, reverse):
+                            if os.path.exists(path):
+                                os.unlink(path)
+        if phrases is not None or bigrams is not None:
+            words = writer.word_table()
+            try:
+                if phrases is not None:
+                    writer.add_bigrams(
+                        count_bigrams(words, phrases, memory_limit, tmp_dir,
+                                      min_count=min_pair_count),
+                        len(words), SCORE_STEP)
+                else:
+                    # ids of the same words are in the same order
+                    step, pairs = bigrams
+                    writer.add_bigrams(
+                        ((i, j, score) for i, j, score in (
+                            (words.find(left), words.find(right), score)
+                            for left, right, score in pairs)
+                         if i >= 0 and j >= 0),
+                        len(words), step)
+            finally:
+                words.mm.close()
+        writer.add_meta('deletes_distance', DELETES_DISTANCE)
+        if shard is not None:
+            writer.add_meta('shard', tuple(shard))
+        writer.close()
 
-        good_words = set(words)
-        return dict(
-            good_words=good_words,
-            reverse=dict(reverse),
-            weights=weights,
-            corpus=dict(corpus)
-        )
+    @classmethod
+    def add_delta(cls, filename, records):
+        """
+        Append (word, weight) records to the log of the index, weight is
+        None for the removed words, see delta. Loaded correctors get them
+        with load_update.
+        """
+        if not storage.is_index(filename):
+            raise RuntimeError('{} is not in the mmap format, convert it '
+                               'again to update it'.format(filename))
+        append_log(filename, records)
 
+    @classmethod
+    def compact(cls, filename, fd, memory_limit=CONVERT_MEMORY_LIMIT,
+                tmp_dir=None, phrases=None, min_pair_count=MIN_PAIR_COUNT,
+                jobs=1):
+        """
+        Write the index with the records of its log to fd, the log has to
+        be locked and emptied by the caller, see delta.locked. The bigrams
+        of the index are kept for the words left unless phrases are given,
+        a shard stays the same shard.
+        """
+        index = storage.IndexFile(filename)
+        delta = Delta(index.words, None)
+        delta.apply(read_log(filename)[0])
+        items = chain(changed_items(index.words.items(), delta.changed),
+                      delta.added.items())
+        bigrams = index.tables.get('bigrams')
+        if bigrams is not None:
+            bigrams = bigrams.step, bigrams.pairs(index.words)
+        cls.convert((WordTuple(word, None, weight, None)
+                     for word, weight in items),
+                    fd, memory_limit, tmp_dir, phrases=phrases,
+                    min_pair_count=min_pair_count, bigrams=bigrams, jobs=jobs,
+                    shard=index.meta.get('shard'))
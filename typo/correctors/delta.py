@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Words set or removed since an index was built. A delta is a text in utf-8,
+a record per line:
+
+    <hits>\t<word>    the word is added or gets the hits
+    -\t<word>         the word is removed
+
+Deltas are appended to the log next to the index (<index>.log) and put
+on top of its tables when it is loaded, convert --compact writes them
+into the index and empties the log. Records set the weight of a word,
+so applying one twice changes nothing.
+"""
+import errno
+import fcntl
+import io
+import logging
+import os
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+REMOVED = '-'
+
+
+def log_path(filename):
+    return '{}.log'.format(filename)
+
+
+def parse_record(line):
+    """ (word, weight) of a line of a delta, weight is None if removed """
+    hits, sep, word = line.rstrip(u'\r\n').partition(u'\t')
+    word = word.strip()
+    if not sep or not word or u' ' in word:
+        raise ValueError('not a delta record: {!r}'.format(line))
+    if hits == REMOVED:
+        return word, None
+    if not hits.isdigit():
+        raise ValueError('not a delta record: {!r}'.format(line))
+    return word, min(int(hits), storage.MAX_WEIGHT)
+
+
+def format_record(word, weight):
+    hits = REMOVED if weight is None else str(weight)
+    return u'{}\t{}\n'.format(hits, word)
+
+
+def read_delta(filename):
+    """ The records of a delta file, ValueError names a broken line """
+    records = []
+    with io.open(filename, encoding='utf-8') as fd:
+        for number, line in enumerate(fd, 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(parse_record(line))
+            except ValueError as e:
+                raise ValueError('{}:{}: {}'.format(filename, number, e))
+    return records
+
+
+@contextmanager
+def locked(filename):
+    """
+    The log of an index opened for appending and locked, a compaction
+    holds the lock until the log is emptied
+    """
+    with open(log_path(filename), 'ab') as fd:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+        try:
+            yield fd
+        finally:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_UN)
+
+
+def append_log(filename, records):
+    """ Append records to the log of the index at once """
+    data = u''.join(format_record(word, weight)
+                    for word, weight in records).encode('utf-8')
+    with locked(filename) as fd:
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def read_log(filename, offset=0):
+    """
+    (records, offset) of the log of the index from offset to its last
+    complete line, ([], 0) without a log
+    """
+    try:
+        fd = open(log_path(filename), 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return [], 0
+        raise
+    with fd:
+        fd.seek(offset)
+        data = fd.read()
+    # a line is written by append_log as a whole, but may be read
+    # before it is
+    data = data[:data.rfind('\n') + 1]
+    records = [parse_record(line)
+               for line in data.decode('utf-8').splitlines() if line]
+    return records, offset + len(data)
+
+
+class Delta(object):
+    """
+    Words set and removed since the base index was built. Its tables
+    are not touched, overlay() wraps them: words the base has are
+    filtered or get their new weight, words it has not are added after
+    its ones and get the next ids.
+    """
+
+    def __init__(self, words, keys):
+        # the word table of the base index, and a function of a word
+        # returning {posting table: keys listing the word}
+        self.words = words
+        self.keys = keys
+        self.changed = {}  # word of the base -> weight, None if removed
+        self.added = OrderedDict()  # word -> weight
+
+    def __len__(self):
+        return len(self.changed) + len(self.added)
+
+    def copy(self):
+        delta = Delta(self.words, self.keys)
+        delta.changed = dict(self.changed)
+        delta.added = OrderedDict(self.added)
+        return delta
+
+    def apply(self, records):
+        for word, weight in records:
+            if word in self.changed or word in self.words:
+                self.changed[word] = weight
+            elif weight is None:
+                self.added.pop(word, None)
+            else:
+                # a word set again keeps its id
+                self.added[word] = weight
+
+    def overlay(self, attributes):
+        """ attributes of the index with the delta on top of them """
+        count = len(self.words)
+        changed_ids = dict((self.words.find(word.encode('utf-8')), weight)
+                           for word, weight in self.changed.items())
+        added = list(self.added.items())
+        postings = defaultdict(lambda: defaultdict(list))
+        buckets = defaultdict(list)
+        first_letters = defaultdict(list)
+        for i, (word, weight) in enumerate(added, count):
+            for name, keys in self.keys(word).items():
+                for key in keys:
+                    postings[name][key].append((word, weight))
+            buckets[ord(word[0]), len(word)].append((i, word, weight))
+            first_letters[word[0]].append((word, i))
+
+        result = dict(attributes)
+        words = WordsOverlay(self.words, changed_ids, added)
+        result.update(words=words, good_words=words, weights=words)
+        for name in ('reverse', 'deletes'):
+            if attributes.get(name) is not None:
+                result[name] = PostingsOverlay(attributes[name], self.changed,
+                                               postings[name])
+        result['corpus'] = CorpusOverlay(attributes['corpus'], self.changed,
+                                         buckets)
+        if attributes.get('trie') is not None:
+            removed = set(i for i, weight in changed_ids.items()
+                          if weight is None)
+            result['trie'] = TrieOverlay(attributes['trie'], removed,
+                                         first_letters)
+        return result
+
+
+class WordsOverlay(object):
+    """
+    word -> weight of the base words table and a delta. Ids of the words
+    of the base do not change, find() returns only them: other tables,
+    bigrams among them, refer to the base words.
+    """
+
+    def __init__(self, words, changed_ids, added):
+        self.words = words
+        self.changed_ids = changed_ids  # id -> weight, None if removed
+        self.added = added  # [(word, weight)] of the ids after the base
+        self.added_weights = dict(added)
+
+    def __len__(self):
+        return len(self.words) + len(self.added)
+
+    def find(self, key):
+        i = self.words.find(key)
+        if i >= 0 and self.changed_ids.get(i, 0) is None:
+            return -1
+        return i
+
+    def word(self, i):
+        if i >= len(self.words):
+            return self.added[i - len(self.words)][0]
+        return self.words.word(i)
+
+    def weight(self, i):
+        if i >= len(self.words):
+            return self.added[i - len(self.words)][1]
+        weight = self.changed_ids.get(i)
+        return self.words.weight(i) if weight is None else weight
+
+    def get(self, word, default=None):
+        if word in self.added_weights:
+            return self.added_weights[word]
+        i = self.find(word.encode('utf-8'))
+        return default if i < 0 else self.weight(i)
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        weight = self.get(word)
+        if weight is None:
+            raise KeyError(word)
+        return weight
+
+
+def changed_items(items, changed):
+    # (word, weight) items of the base with the weights of a delta
+    for word, weight in items:
+        if word in changed:
+            weight = changed[word]
+            if weight is None:
+                continue
+        yield word, weight
+
+
+class PostingsOverlay(object):
+    """ key -> [(word, weight), ...] of a base posting table and a delta """
+
+    def __init__(self, postings, changed, added):
+        self.postings = postings
+        self.changed = changed
+        self.added = added  # key -> [(word, weight)] of the added words
+
+    def __contains__(self, key):
+        return key in self.added or key in self.postings
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+    def get(self, key, default=None):
+        base = self.postings.get(key)
+        if base is None and key not in self.added:
+            return default
+        result = list(changed_items(base or (), self.changed))
+        result.extend(self.added.get(key, ()))
+        return result
+
+
+class CorpusOverlay(object):
+    """ The corpus view of the base and the words added by a delta """
+
+    def __init__(self, corpus, changed, buckets):
+        self.corpus = corpus
+        self.changed = changed
+        self.added = buckets  # (ord(first letter), length) -> [(id, word, weight)]
+        self.buckets = corpus.buckets
+        self.added_lengths = defaultdict(set)
+        for key, length in buckets:
+            self.added_lengths[key].add(length)
+
+    def lengths(self, key):
+        return sorted(self.added_lengths.get(key, set()).union(
+            self.corpus.lengths(key)))
+
+    def bucket(self, key, length):
+        rows = []
+        for i, word, weight in self.corpus.bucket(key, length):
+            if word in self.changed:
+                weight = self.changed[word]
+                if weight is None:
+                    continue
+            rows.append((i, word, weight))
+        return rows + self.added.get((key, length), [])
+
+    def __contains__(self, key):
+        return key in self.added_lengths or key in self.corpus
+
+    def __getitem__(self, key):
+        # for the indexes without buckets, see PythonEngine.group
+        items = OrderedDict()
+        if key in self.corpus:
+            items.update(changed_items(self.corpus[key].items(), self.changed))
+        for length in sorted(self.added_lengths.get(key, ())):
+            items.update((word, weight)
+                         for _, word, weight in self.added[key, length])
+        if not items:
+            raise KeyError(key)
+        return items
+
+
+class TrieOverlay(object):
+    """ Prefixes of the base trie without the removed words, and the added ones """
+
+    def __init__(self, trie, removed, first_letters):
+        self.trie = trie
+        self.removed = removed  # ids
+        self.added = first_letters  # first letter -> [(word, id)]
+
+    def prefixes(self, word, start=0):
+        found = [(end, i) for end, i in self.trie.prefixes(word, start)
+                 if i not in self.removed]
+        for cword, i in self.added.get(word[start:start + 1], ()):
+            if word.startswith(cword, start):
+                found.append((start + len(cword), i))
+        found.sort()
+        return found
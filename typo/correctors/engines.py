@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Engines find the words of the corpus within an edit distance of a word,
+TypoDefault(..., engine='numpy') selects one by its engine_name.
+
+What an engine keeps of a first letter is made on the first use of the
+letter, with memory_limit the least recently used letters are dropped
+beyond it.
+"""
+import logging
+import sys
+from collections import defaultdict
+
+import Levenshtein
+
+from utils import LRUCache
+
+try:
+    import numpy
+except ImportError:  # only the numpy engine needs it
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+ENGINES = {}
+# bytes of a (position, word, weight) row but the word, about
+ROW_SIZE = sys.getsizeof((0, u'', 0)) + 2 * sys.getsizeof(0)
+
+
+def register_engine(cls):
+    if not hasattr(cls, 'engine_name'):
+        raise RuntimeError('{} without engine_name, maybe is not an engine'
+                           .format(cls))
+    ENGINES[cls.engine_name] = cls
+    return cls
+
+
+def rows_size(rows):
+    """ About the bytes taken by (position, word, weight) rows """
+    return sum(ROW_SIZE + sys.getsizeof(cword) for _, cword, _ in rows)
+
+
+def letter_cache(memory_limit):
+    # of the values weighing their size, 0 does not limit it
+    return LRUCache(memory_limit or sys.maxsize, weigh=lambda value: value[0])
+
+
+@register_engine
+class PythonEngine(object):
+    """ Levenshtein.distance word by word """
+    engine_name = 'python'
+
+    def __init__(self, index, memory_limit=0):
+        self.index = index
+        self.memory_limit = memory_limit
+        # (size, {length: rows}) of the first letters of an index
+        # without buckets
+        self.grouped = letter_cache(memory_limit)
+
+    def caches(self):
+        """ LRUCache of every kind of what is kept of the first letters """
+        return [self.grouped]
+
+    def lengths(self, key):
+        """ Lengths of the words with the first letter ord(key) """
+        corpus = self.index.corpus
+        if getattr(corpus, 'buckets', None) is not None:
+            return corpus.lengths(key)
+        return sorted(self.group(key))
+
+    def rows(self, key, length):
+        """ (position in the corpus, cword, weight) of a first letter and length """
+        corpus = self.index.corpus
+        if getattr(corpus, 'buckets', None) is not None:
+            return corpus.bucket(key, length)
+        return self.group(key).get(length, ())
+
+    def group(self, key):
+        # the corpus of an index without buckets, grouped on first use
+        entry = self.grouped.get(key)
+        if entry is None:
+            grouped = self.read_group(key)
+            entry = sum(rows_size(rows) for rows in grouped.values()), grouped
+            self.grouped.set(key, entry)
+        return entry[1]
+
+    def read_group(self, key):
+        grouped = defaultdict(list)
+        for position, (cword, weight) in enumerate(
+                self.index.corpus[key].items()):
+            grouped[len(cword)].append((position, cword, weight))
+        return dict(grouped)
+
+    def scan(self, word, skip_distance, enough=None, deadline=None):
+        """
+        Return (cword, weight, distance) of the words with the first letter
+        of word within skip_distance of it, in the order of the corpus.
+        Only lengths within skip_distance of the word are visited. Once
+        enough words are within distance 1, lengths further than 1 are not
+        visited at all: better_candidates stops at the first distance with
+        enough candidates, so nothing it would take is missed. Once the
+        deadline is over, the words of the lengths visited are returned.
+        """
+        key = ord(word[0])
+        if key not in self.index.corpus:
+            return []
+        length = len(word)
+        near = range(length - 1, length + 2)
+        far = [l for l in range(length - skip_distance, length + skip_distance + 1)
+               if l not in near]
+
+        found = []
+        for l in near:
+            if deadline is not None and deadline.exceeded():
+                break
+            found.extend(self.scan_length(key, l, word, skip_distance))
+        else:
+            if enough is None or sum(1 for f in found if f[3] == 1) < enough:
+                for l in far:
+                    if deadline is not None and deadline.exceeded():
+                        break
+                    found.extend(self.scan_length(key, l, word, skip_distance))
+        found.sort()
+        return [(cword, weight, d) for _, cword, weight, d in found]
+
+    def scan_length(self, key, length, word, skip_distance):
+        """ (position, cword, weight, distance) of the words of a length """
+        found = []
+        for position, cword, weight in self.rows(key, length):
+            d = Levenshtein.distance(cword, word)
+            if d <= skip_distance:
+                found.append((position, cword, weight, d))
+        return found
+
+
+class Bucket(object):
+    """
+    Words of one first letter and length. Large buckets keep the letters
+    as indexes in the alphabet of the first letter, a row per position.
+    """
+
+    def __init__(self, rows, length, alphabet, vectorize):
+        self.positions, self.cwords, self.weights = zip(*rows)
+        self.columns = None
+        self.nbytes = rows_size(rows)
+        if vectorize:
+            self.columns = numpy.array(
+                [[alphabet[c] for c in cword] for cword in self.cwords],
+                dtype=numpy.uint32).reshape(len(rows), length).T.copy()
+            self.nbytes += self.columns.nbytes
+
+    def scan(self, word, skip_distance, alphabet):
+        if self.columns is None:
+            found = []
+            for position, cword, weight in zip(self.positions, self.cwords,
+                                               self.weights):
+                d = Levenshtein.distance(cword, word)
+                if d <= skip_distance:
+                    found.append((position, cword, weight, d))
+            return found
+
+        # bit i of peq[letter] is set when the letter is at i in word
+        peq = [0] * (len(alphabet) + 1)
+        for i, c in enumerate(word):
+            if c in alphabet:
+                peq[alphabet[c]] |= 1 << i
+        peq = numpy.array(peq, dtype=numpy.uint64)
+        distances = myers_distances(len(word), peq, self.columns)
+        return [(self.positions[i], self.cwords[i], self.weights[i],
+                 int(distances[i]))
+                for i in numpy.flatnonzero(distances <= skip_distance)]
+
+
+def myers_distances(length, peq, columns):
+    """
+    Edit distances of a word to the words of columns at once, bit-parallel
+    (Myers 1999, Hyyro 2001). peq[letter] has bit i set when the letter is
+    at position i of the word, so the word is at most 64 letters.
+    """
+    one = numpy.uint64(1)
+    high = numpy.uint64(1 << (length - 1))
+    count = columns.shape[1]
+    # vertical deltas of the last column: +1 everywhere, none -1
+    pv = numpy.full(count, numpy.uint64(0xffffffffffffffff), dtype=numpy.uint64)
+    mv = numpy.zeros(count, dtype=numpy.uint64)
+    score = numpy.full(count, length, dtype=numpy.int32)
+    for column in columns:
+        eq = peq[column]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        score += (ph & high) != 0
+        score -= (mh & high) != 0
+        # the first row grows by one a letter, the distance to ''
+        ph = (ph << one) | one
+        mh = mh << one
+        pv = mh | ~(xv | ph)
+        mv = ph & xv
+    return score
+
+
+@register_engine
+class NumpyEngine(PythonEngine):
+    """
+    Compares a word with all the words of a first letter and a length at
+    once. Buckets are built on the first use of a first letter and hold
+    a copy of its words; small ones are scanned with Levenshtein, numpy
+    costs more than it saves there.
+    """
+    engine_name = 'numpy'
+    MIN_BUCKET = 1024
+    MAX_LENGTH = 64  # bits of a machine word
+
+    def __init__(self, index, memory_limit=0):
+        if numpy is None:
+            raise RuntimeError('the numpy engine requires numpy')
+        super(NumpyEngine, self).__init__(index, memory_limit)
+        # (size, alphabet, {length: Bucket}) of the first letters
+        self.letters = letter_cache(memory_limit)
+
+    def caches(self):
+        return [self.grouped, self.letters]
+
+    def buckets(self, key):
+        # ord(first letter) -> (alphabet, {length: Bucket})
+        entry = self.letters.get(key)
+        if entry is None:
+            corpus = self.index.corpus
+            if getattr(corpus, 'buckets', None) is not None:
+                grouped = dict((length, corpus.bucket(key, length))
+                               for length in corpus.lengths(key))
+            else:
+                # the buckets are a copy, the groups are not kept
+                grouped = self.read_group(key)
+            letters = set()
+            for rows in grouped.values():
+                for _, cword, _ in rows:
+                    letters.update(cword)
+            # 0 stands for the letters of a word missing in the alphabet
+            alphabet = dict((c, i) for i, c in enumerate(sorted(letters), 1))
+            buckets = dict(
+                (length, Bucket(rows, length, alphabet,
+                                len(rows) >= self.MIN_BUCKET))
+                for length, rows in grouped.items() if rows)
+            entry = (sum(b.nbytes for b in buckets.values()), alphabet,
+                     buckets)
+            self.letters.set(key, entry)
+        return entry[1:]
+
+    def scan_length(self, key, length, word, skip_distance):
+        if len(word) > self.MAX_LENGTH:
+            return super(NumpyEngine, self).scan_length(key, length, word,
+                                                        skip_distance)
+        alphabet, buckets = self.buckets(key)
+        if length not in buckets:
+            return []
+        return buckets[length].scan(word, skip_distance, alphabet)
@@ -0,0 +1,858 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped index format.
+
+The file starts with MAGIC and ends with a marshal encoded directory
+followed by its offset (uint64) and MAGIC again. Every table is a sorted
+string arena plus offset tables, all integers are little-endian uint32:
+
+    keys          utf-8 keys sorted bytewise, back to back
+    key_offsets   count + 1 offsets of the keys inside the arena
+    slots         open addressing hash table of key ids + 1 (crc32, linear)
+    weights       one weight per key (word tables)
+    values        word ids of every key, back to back (posting tables)
+    value_offsets count + 1 offsets of the values in the ids
+
+A trie of the words is a table of nodes (first edge, number of edges,
+word id + 1) in postorder, so the root is the last one, and a table of
+edges (code point, node) sorted by code point for every node.
+
+The corpus is bucketed by the first letter and length of the words: ids
+of the words ordered by (first letter, length, word) and the range of
+every bucket in them.
+
+A bigram model maps pairs of word ids to how much likelier the right
+word is after the left one than anywhere, the log of P(right|left) /
+P(right) quantized to an int8 of step nats. Pairs are sorted by ids,
+left_offsets holds count + 1 offsets of the pairs of every left word.
+
+Nothing of a larger index is unpacked on load, so processes opening the
+same index share one page cache copy of it. The word table of an index
+of at most MEMORY_WORDS words is decoded on load (see MemoryWordTable)
+and every process holds its own copy, the other tables stay mapped.
+"""
+import heapq
+import logging
+import marshal
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'TYPOIDX\x01'
+MAX_WEIGHT = 0xffffffff
+TRAILER = struct.Struct('<Q8s')
+UINT = struct.Struct('<I')
+UINT_PAIR = struct.Struct('<II')
+TRIE_NODE = struct.Struct('<III')
+TRIE_EDGE = UINT_PAIR
+INT8 = struct.Struct('<b')
+# word tables of at most that many words are decoded on load
+MEMORY_WORDS = 1 << 15
+
+# a posting table written by write_postings_part
+PostingsPart = namedtuple('PostingsPart', 'path, count, keys_size, values_count')
+
+
+def is_index(filename):
+    with open(filename, 'rb') as fd:
+        return fd.read(len(MAGIC)) == MAGIC
+
+
+def _hash(key):
+    return zlib.crc32(key) & 0xffffffff
+
+
+class Table(object):
+    """ Sorted keys with an exact match hash on top of them """
+
+    def __init__(self, mm, section):
+        self.mm = mm
+        self.count = section['count']
+        self.keys = section['keys']
+        self.key_offsets = section['key_offsets']
+        self.slots = section['slots']
+        self.mask = section['nslots'] - 1
+
+    def __len__(self):
+        return self.count
+
+    def key(self, i):
+        start, end = UINT_PAIR.unpack_from(self.mm, self.key_offsets + 4 * i)
+        return self.mm[self.keys + start:self.keys + end]
+
+    def find(self, key):
+        """ Return id of utf-8 encoded key or -1 """
+        slot = _hash(key) & self.mask
+        while True:
+            i = UINT.unpack_from(self.mm, self.slots + 4 * slot)[0]
+            if not i:
+                return -1
+            if self.key(i - 1) == key:
+                return i - 1
+            slot = (slot + 1) & self.mask
+
+    def lower_bound(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class WordTable(Table):
+    """ Read only word -> weight mapping, stands for good_words too """
+
+    in_memory = False
+
+    def __init__(self, mm, section):
+        super(WordTable, self).__init__(mm, section)
+        self.weights = section['weights']
+
+    def word(self, i):
+        return self.key(i).decode('utf-8')
+
+    def weight(self, i):
+        return UINT.unpack_from(self.mm, self.weights + 4 * i)[0]
+
+    def __contains__(self, word):
+        return self.find(word.encode('utf-8')) >= 0
+
+    def __getitem__(self, word):
+        i = self.find(word.encode('utf-8'))
+        if i < 0:
+            raise KeyError(word)
+        return self.weight(i)
+
+    def get(self, word, default=None):
+        i = self.find(word.encode('utf-8'))
+        return default if i < 0 else self.weight(i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.word(i)
+
+    def items(self, start=0, end=None):
+        for i in range(start, self.count if end is None else end):
+            yield self.word(i), self.weight(i)
+
+
+class MemoryWordTable(WordTable):
+    """
+    A WordTable decoded on load: a probe of a small table costs more than
+    holding its words, see MEMORY_WORDS
+    """
+
+    in_memory = True
+
+    def __init__(self, mm, section):
+        super(MemoryWordTable, self).__init__(mm, section)
+        self.word_list = [self.key(i).decode('utf-8')
+                          for i in range(self.count)]
+        self.weight_list = _from_le(
+            self.mm[self.weights:self.weights + 4 * self.count])
+        self.ids = dict((word, i) for i, word in enumerate(self.word_list))
+
+    def find(self, key):
+        return self.ids.get(key.decode('utf-8'), -1)
+
+    def word(self, i):
+        return self.word_list[i]
+
+    def weight(self, i):
+        return self.weight_list[i]
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def __getitem__(self, word):
+        return self.weight_list[self.ids[word]]
+
+    def get(self, word, default=None):
+        i = self.ids.get(word)
+        return default if i is None else self.weight_list[i]
+
+    def items(self, start=0, end=None):
+        end = self.count if end is None else end
+        return zip(self.word_list[start:end], self.weight_list[start:end])
+
+
+class PostingTable(Table):
+    """ Read only key -> [(word, weight), ...] mapping """
+
+    def __init__(self, mm, section, words):
+        super(PostingTable, self).__init__(mm, section)
+        self.values = section['values']
+        self.value_offsets = section['value_offsets']
+        self.words = words
+
+    def postings(self, i):
+        start, end = UINT_PAIR.unpack_from(self.mm, self.value_offsets + 4 * i)
+        ids = struct.unpack_from('<{}I'.format(end - start), self.mm,
+                                 self.values + 4 * start)
+        words = self.words
+        return [(words.word(w), words.weight(w)) for w in ids]
+
+    def __contains__(self, key):
+        return self.find(key.encode('utf-8')) >= 0
+
+    def __getitem__(self, key):
+        i = self.find(key.encode('utf-8'))
+        if i < 0:
+            raise KeyError(key)
+        return self.postings(i)
+
+    def get(self, key, default=None):
+        i = self.find(key.encode('utf-8'))
+        return default if i < 0 else self.postings(i)
+
+
+class WordRange(object):
+    def __init__(self, words, start, end):
+        self.words = words
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def items(self):
+        return self.words.items(self.start, self.end)
+
+
+class CorpusView(object):
+    """
+    ord(first letter) -> words, the same shape as the marshal corpus.
+    Words are sorted, so a partition is a contiguous range of ids.
+    """
+
+    def __init__(self, words, buckets=None):
+        self.words = words
+        self.ranges = {}
+        # the rows of the buckets of words held in memory
+        self.bucket_rows = {}
+        # indexes built before the buckets were added do not have them
+        self.buckets = None
+        if buckets:
+            self.buckets = buckets['ranges']
+            self.bucket_ids = buckets['ids']
+            self.bucket_lengths = {}
+            for key, length in self.buckets:
+                self.bucket_lengths.setdefault(key, []).append(length)
+
+    def range(self, key):
+        if key not in self.ranges:
+            start = self.words.lower_bound(unichr(key).encode('utf-8'))
+            end = self.words.lower_bound(unichr(key + 1).encode('utf-8'))
+            self.ranges[key] = WordRange(self.words, start, end)
+        return self.ranges[key]
+
+    def lengths(self, key):
+        return sorted(self.bucket_lengths.get(key, ()))
+
+    def bucket(self, key, length):
+        """ (word id, word, weight) of the words of a first letter and length """
+        if self.words.in_memory:
+            rows = self.bucket_rows.get((key, length))
+            if rows is None:
+                rows = self.bucket_rows[key, length] = \
+                    self.read_bucket(key, length)
+            return rows
+        return self.read_bucket(key, length)
+
+    def read_bucket(self, key, length):
+        start, end = self.buckets.get((key, length), (0, 0))
+        ids = struct.unpack_from('<{}I'.format(end - start), self.words.mm,
+                                 self.bucket_ids + 4 * start)
+        words = self.words
+        return [(i, words.word(i), words.weight(i)) for i in ids]
+
+    def __contains__(self, key):
+        return len(self.range(key)) > 0
+
+    def __getitem__(self, key):
+        word_range = self.range(key)
+        if not word_range:
+            raise KeyError(key)
+        return word_range
+
+
+class Trie(object):
+    """ Walks the words char by char without making substrings """
+    # children of the nodes this close to the root are kept in dicts,
+    # every walk starts there
+    CACHED_DEPTH = 2
+
+    def __init__(self, mm, section):
+        self.mm = mm
+        self.nodes = section['nodes']
+        self.edges = section['edges']
+        self.root = section['root']
+        self.cache = {}
+
+    def node(self, node):
+        """ (first edge, edges, word id + 1) """
+        return TRIE_NODE.unpack_from(self.mm, self.nodes + 12 * node)
+
+    def children(self, node):
+        """ {code point: (child, its record)} """
+        children = self.cache.get(node)
+        if children is None:
+            first, count, _ = self.node(node)
+            children = {}
+            for j in range(first, first + count):
+                code, child = TRIE_EDGE.unpack_from(self.mm, self.edges + 8 * j)
+                children[code] = (child, self.node(child))
+            self.cache[node] = children
+        return children
+
+    def prefixes(self, word, start=0):
+        """ Yield (end, word id) of the words equal to word[start:end] """
+        mm, edges = self.mm, self.edges
+        node = self.root
+        for end in range(start, len(word)):
+            char = ord(word[end])
+            if end - start < self.CACHED_DEPTH:
+                child = self.children(node).get(char)
+                if child is None:
+                    return
+                node, (first, count, i) = child
+            else:
+                lo, hi = first, first + count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    code, node = TRIE_EDGE.unpack_from(mm, edges + 8 * mid)
+                    if code < char:
+                        lo = mid + 1
+                    elif code > char:
+                        hi = mid
+                    else:
+                        break
+                else:
+                    return
+                first, count, i = self.node(node)
+            if i:
+                yield end + 1, i - 1
+
+
+class Bigrams(object):
+    """ Pairs of word ids -> log(P(right|left) / P(right)), 0 if unknown """
+
+    def __init__(self, mm, section):
+        self.mm = mm
+        self.step = section['step']
+        self.left_offsets = section['left_offsets']
+        self.rights = section['rights']
+        self.scores = section['scores']
+
+    def score(self, left, right):
+        lo, hi = UINT_PAIR.unpack_from(self.mm, self.left_offsets + 4 * left)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = UINT.unpack_from(self.mm, self.rights + 4 * mid)[0]
+            if i < right:
+                lo = mid + 1
+            elif i > right:
+                hi = mid
+            else:
+                return INT8.unpack_from(self.mm, self.scores + mid)[0] * self.step
+        return 0.0
+
+    def pairs(self, words):
+        """ Yield (utf-8 left, utf-8 right, quantized score) sorted by ids """
+        start = 0
+        for left in range(len(words)):
+            end = UINT.unpack_from(self.mm, self.left_offsets + 4 * (left + 1))[0]
+            for k in range(start, end):
+                right = UINT.unpack_from(self.mm, self.rights + 4 * k)[0]
+                score = INT8.unpack_from(self.mm, self.scores + k)[0]
+                yield words.key(left), words.key(right), score
+            start = end
+
+
+class IndexFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, magic = TRAILER.unpack_from(self.mm, len(self.mm) - TRAILER.size)
+        if self.mm[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise RuntimeError('{} is not a typo index'.format(filename))
+        directory = marshal.loads(self.mm[offset:len(self.mm) - TRAILER.size])
+        self.meta = directory['meta']
+        if directory['words']['count'] <= MEMORY_WORDS:
+            self.words = MemoryWordTable(self.mm, directory['words'])
+        else:
+            self.words = WordTable(self.mm, directory['words'])
+        self.tables = dict(
+            (name, PostingTable(self.mm, section, self.words))
+            for name, section in directory['postings'].items())
+        if directory.get('trie'):
+            self.tables['trie'] = Trie(self.mm, directory['trie'])
+        self.buckets = directory.get('buckets')
+        if directory.get('bigrams'):
+            self.tables['bigrams'] = Bigrams(self.mm, directory['bigrams'])
+
+    def attributes(self):
+        """ Corrector attributes, the same ones a marshal index has """
+        result = dict(self.meta)
+        result.update(self.tables)
+        result.update(
+            words=self.words,
+            good_words=self.words,
+            weights=self.words,
+            corpus=CorpusView(self.words, self.buckets),
+        )
+        return result
+
+
+def _to_le(values):
+    if sys.byteorder != 'little' and values.itemsize > 1:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _from_le(data, typecode='I'):
+    values = array(typecode)
+    values.fromstring(data)
+    if sys.byteorder != 'little' and values.itemsize > 1:
+        values.byteswap()
+    return values
+
+
+class Column(object):
+    """ Append only array (uint32 by default) kept in a temporary file """
+    chunk_size = 1 << 16
+
+    def __init__(self, tmp_dir=None, typecode='I'):
+        self.fd = tempfile.TemporaryFile(dir=tmp_dir)
+        self.typecode = typecode
+        self.chunk = array(typecode)
+        self.count = 0
+
+    @property
+    def itemsize(self):
+        return self.chunk.itemsize
+
+    def __len__(self):
+        return self.count + len(self.chunk)
+
+    def append(self, value):
+        self.chunk.append(value)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, values):
+        self.chunk.extend(values)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.fd.write(_to_le(self.chunk))
+        self.count += len(self.chunk)
+        self.chunk = array(self.typecode)
+
+    def __iter__(self):
+        self.flush()
+        self.fd.seek(0)
+        while True:
+            data = self.fd.read(self.itemsize * self.chunk_size)
+            if not data:
+                break
+            for value in _from_le(data, self.typecode):
+                yield value
+
+    def copy_to(self, fd):
+        self.flush()
+        self.fd.seek(0)
+        shutil.copyfileobj(self.fd, fd)
+
+    def close(self):
+        self.fd.close()
+
+
+class ExternalSorter(object):
+    """
+    Sort tuples that do not fit in memory: runs of about memory_limit
+    bytes are sorted and spilled to temporary files, then merged.
+    """
+    record_overhead = 100  # tuple, str and int objects of a record
+
+    def __init__(self, memory_limit, tmp_dir=None):
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.records = []
+        self.size = 0
+        self.runs = []
+
+    def add(self, record):
+        self.records.append(record)
+        self.size += len(record[0]) + self.record_overhead
+        if self.size >= self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        self.records.sort()
+        run = tempfile.TemporaryFile(dir=self.tmp_dir)
+        for record in self.records:
+            marshal.dump(record, run)
+        self.runs.append(run)
+        self.records = []
+        self.size = 0
+
+    @staticmethod
+    def read_run(run):
+        run.seek(0)
+        while True:
+            try:
+                yield marshal.load(run)
+            except EOFError:
+                break
+        run.close()
+
+    def __iter__(self):
+        if not self.runs:
+            self.records.sort()
+            records, self.records = self.records, []
+            return iter(records)
+        if self.records:
+            self.spill()
+        runs, self.runs = self.runs, []
+        return heapq.merge(*[self.read_run(run) for run in runs])
+
+    def dump(self):
+        """ Path of a named temporary file of the sorted records, see load """
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as run:
+                for record in self:
+                    marshal.dump(record, run)
+        except Exception:
+            os.unlink(path)
+            raise
+        return path
+
+    def load(self, path):
+        """ Merge the records dumped to path by another sorter, path is removed """
+        run = open(path, 'rb')
+        os.unlink(path)
+        self.runs.append(run)
+
+
+def write_postings_part(items, tmp_dir=None):
+    """
+    Write the posting table of sorted (utf-8 key, [word id, ...]) pairs
+    without its hash slots to a named temporary file: the keys, count + 1
+    key offsets, count hashes, the values and count + 1 value offsets.
+    IndexWriter.add_postings_parts puts the parts of a table together.
+    """
+    key_offsets = Column(tmp_dir)
+    key_offsets.append(0)
+    hashes = Column(tmp_dir)
+    values = Column(tmp_dir)
+    value_offsets = Column(tmp_dir)
+    value_offsets.append(0)
+    keys_size = 0
+    fd, path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as part:
+            for key, ids in items:
+                part.write(key)
+                keys_size += len(key)
+                key_offsets.append(keys_size)
+                hashes.append(_hash(key))
+                for i in ids:
+                    values.append(i)
+                value_offsets.append(len(values))
+            count, values_count = len(hashes), len(values)
+            for column in (key_offsets, hashes, values, value_offsets):
+                column.copy_to(part)
+                column.close()
+    except Exception:
+        os.unlink(path)
+        raise
+    return PostingsPart(path, count, keys_size, values_count)
+
+
+def _read_column(fd, count, chunk_size=Column.chunk_size):
+    # arrays of the next count uint32 of fd
+    while count:
+        values = _from_le(fd.read(4 * min(count, chunk_size)))
+        if not values:
+            raise EOFError('{} ends before its columns'.format(fd.name))
+        count -= len(values)
+        yield values
+
+
+class TrieBuilder(object):
+    """
+    Build a trie of words added in sorted order. Only the nodes on the
+    path of the last word are kept in memory, the closed ones are
+    written out in postorder.
+    """
+
+    def __init__(self, tmp_dir=None):
+        self.nodes = Column(tmp_dir)
+        self.edges = Column(tmp_dir)
+        # [code point, word id + 1, [(code point, node), ...]]
+        self.path = [[None, 0, []]]
+        self.last = u''
+
+    def add(self, word, i):
+        common = 0
+        for a, b in zip(word, self.last):
+            if a != b:
+                break
+            common += 1
+        self.close(common)
+        for char in word[common:]:
+            self.path.append([ord(char), 0, []])
+        self.path[-1][1] = i + 1
+        self.last = word
+
+    def close(self, depth):
+        while len(self.path) > depth + 1:
+            char, word, children = self.path.pop()
+            self.path[-1][2].append((char, self.write_node(word, children)))
+
+    def write_node(self, word, children):
+        first = len(self.edges) // 2
+        for char, node in children:
+            self.edges.append(char)
+            self.edges.append(node)
+        node = len(self.nodes) // 3
+        self.nodes.append(first)
+        self.nodes.append(len(children))
+        self.nodes.append(word)
+        return node
+
+    def finish(self):
+        self.close(0)
+        _, word, children = self.path[0]
+        return self.write_node(word, children)
+
+
+class IndexWriter(object):
+    """
+    Write the tables one by one, keys of every table must be added
+    in bytewise order of their utf-8 encoding. Tables are streamed to
+    fd, which has to be opened for reading too: hash slots are filled
+    in place through mmap. Only the directory is kept in memory.
+    """
+
+    def __init__(self, fd, tmp_dir=None):
+        self.fd = fd
+        self.tmp_dir = tmp_dir
+        self.fd.write(MAGIC)
+        self.position = len(MAGIC)
+        self.directory = dict(meta={}, words=None, postings={})
+
+    def write(self, data):
+        self.fd.write(data)
+        position = self.position
+        self.position += len(data)
+        return position
+
+    def write_column(self, column):
+        position = self.position
+        column.copy_to(self.fd)
+        self.position += column.itemsize * len(column)
+        column.close()
+        return position
+
+    def write_slots(self, hashes):
+        nslots = 2
+        while nslots < 2 * len(hashes):
+            nslots *= 2
+        mask = nslots - 1
+
+        start = self.position
+        self.position += 4 * nslots
+        self.fd.flush()
+        self.fd.truncate(self.position)
+        mm = mmap.mmap(self.fd.fileno(), self.position)
+        try:
+            for i, h in enumerate(hashes):
+                slot = h & mask
+                while UINT.unpack_from(mm, start + 4 * slot)[0]:
+                    slot = (slot + 1) & mask
+                UINT.pack_into(mm, start + 4 * slot, i + 1)
+        finally:
+            mm.close()
+        self.fd.seek(self.position)
+        hashes.close()
+        return start, nslots
+
+    def write_keys(self, keys, section):
+        key_offsets = Column(self.tmp_dir)
+        key_offsets.append(0)
+        hashes = Column(self.tmp_dir)
+        start = self.position
+        for key in keys:
+            self.write(key)
+            key_offsets.append(self.position - start)
+            hashes.append(_hash(key))
+
+        return self.close_keys(start, key_offsets, hashes, section)
+
+    def close_keys(self, start, key_offsets, hashes, section):
+        # the keys are written from start, their offsets and hashes follow
+        count = len(hashes)
+        key_offsets = self.write_column(key_offsets)
+        slots, nslots = self.write_slots(hashes)
+        section.update(
+            count=count,
+            keys=start,
+            key_offsets=key_offsets,
+            slots=slots,
+            nslots=nslots,
+        )
+        return section
+
+    def add_words(self, items):
+        """ items are sorted (utf-8 word, weight) pairs """
+        weights = Column(self.tmp_dir)
+
+        def keys():
+            for key, weight in items:
+                weights.append(weight)
+                yield key
+
+        section = self.write_keys(keys(), {})
+        section['weights'] = self.write_column(weights)
+        self.directory['words'] = section
+
+    def add_postings(self, name, items):
+        """ items are sorted (utf-8 key, [word id, ...]) pairs """
+        value_offsets = Column(self.tmp_dir)
+        value_offsets.append(0)
+        values = Column(self.tmp_dir)
+
+        def keys():
+            for key, ids in items:
+                for i in ids:
+                    values.append(i)
+                value_offsets.append(len(values))
+                yield key
+
+        section = self.write_keys(keys(), {})
+        self.close_postings(name, values, value_offsets, section)
+
+    def add_postings_parts(self, name, parts):
+        """
+        parts are PostingsPart written by write_postings_part in order,
+        every key of a part sorts after the keys of the previous ones: the
+        table is the one add_postings writes of all their pairs. The files
+        of the parts are removed.
+        """
+        key_offsets = Column(self.tmp_dir)
+        key_offsets.append(0)
+        hashes = Column(self.tmp_dir)
+        values = Column(self.tmp_dir)
+        value_offsets = Column(self.tmp_dir)
+        value_offsets.append(0)
+        start = self.position
+        for part in parts:
+            keys_base, values_base = self.position - start, len(values)
+            with open(part.path, 'rb') as fd:
+                os.unlink(part.path)
+                remaining = part.keys_size
+                while remaining:
+                    data = fd.read(min(remaining, 1 << 20))
+                    self.write(data)
+                    remaining -= len(data)
+                for column, count, base in (
+                        (key_offsets, part.count + 1, keys_base),
+                        (hashes, part.count, None),
+                        (values, part.values_count, None),
+                        (value_offsets, part.count + 1, values_base)):
+                    first = base is not None
+                    for chunk in _read_column(fd, count):
+                        if first:
+                            # the offset 0 of the part ends the previous one
+                            chunk, first = chunk[1:], False
+                        if base:
+                            chunk = array('I', [v + base for v in chunk])
+                        column.extend(chunk)
+        section = self.close_keys(start, key_offsets, hashes, {})
+        self.close_postings(name, values, value_offsets, section)
+
+    def close_postings(self, name, values, value_offsets, section):
+        section['values'] = self.write_column(values)
+        section['value_offsets'] = self.write_column(value_offsets)
+        self.directory['postings'][name] = section
+
+    def add_trie(self, builder):
+        root = builder.finish()
+        self.directory['trie'] = dict(
+            root=root,
+            nodes=self.write_column(builder.nodes),
+            edges=self.write_column(builder.edges),
+        )
+
+    def add_buckets(self, items):
+        """ items are sorted (utf-8 first letter, length, word id) """
+        ids = Column(self.tmp_dir)
+        ranges = {}
+        for (letter, length), group in groupby(items, itemgetter(0, 1)):
+            start = len(ids)
+            for _, _, i in group:
+                ids.append(i)
+            ranges[ord(letter.decode('utf-8')), length] = start, len(ids)
+        self.directory['buckets'] = dict(
+            ids=self.write_column(ids),
+            ranges=ranges,
+        )
+
+    def add_bigrams(self, items, count, step):
+        """
+        items are (left id, right id, quantized score) sorted by ids,
+        count is the number of words
+        """
+        left_offsets = Column(self.tmp_dir)
+        left_offsets.append(0)
+        rights = Column(self.tmp_dir)
+        scores = Column(self.tmp_dir, 'b')
+        left = 0
+        for i, j, score in items:
+            while left < i:
+                left_offsets.append(len(rights))
+                left += 1
+            rights.append(j)
+            scores.append(score)
+        while left < count:
+            left_offsets.append(len(rights))
+            left += 1
+        self.directory['bigrams'] = dict(
+            step=step,
+            left_offsets=self.write_column(left_offsets),
+            rights=self.write_column(rights),
+            scores=self.write_column(scores),
+        )
+
+    def word_table(self):
+        """ The words added so far, mapped from fd """
+        self.fd.flush()
+        mm = mmap.mmap(self.fd.fileno(), self.position,
+                       access=mmap.ACCESS_READ)
+        return WordTable(mm, self.directory['words'])
+
+    def add_meta(self, name, value):
+        self.directory['meta'][name] = value
+
+    def close(self):
+        offset = self.write(marshal.dumps(self.directory))
+        self.write(TRAILER.pack(offset, MAGIC))
@@ -1,11 +1,70 @@
 # -*- coding: utf-8 -*-
+import heapq
 import logging
-from collections import namedtuple
+import math
+import time
+from collections import namedtuple, OrderedDict
 
 logger = logging.getLogger(__name__)
 
 WordTuple = namedtuple('WordTuple', 'keyword, docs, hits, offset')
 TYPO_CLASSES = {}
+MIN_WEIGHT = 1e-12  # of a candidate, the log of 0 is not defined
+
+
+def best_phrase(suggestions):
+    """ Join the best candidates of all chunks of a suggestion """
+    return u''.join(candidates[0][0] for candidates in suggestions)
+
+
+def best_phrases(suggestions, k):
+    """
+    The k best distinct phrases of suggestions, best first, with their
+    weight relative to the best one. A candidate costs the log of how much
+    lighter it is than the first one of its chunk, phrases are popped
+    from a heap in the order of the sum of the costs, and only the
+    neighbours of the popped ones are pushed.
+    """
+    # only chunks with alternatives vary, costs of a chunk do not decrease
+    varying = []
+    costs = []
+    for i, candidates in enumerate(suggestions):
+        if len(candidates) < 2:
+            continue
+        top = max(candidates[0][1], MIN_WEIGHT)
+        chunk_costs = [0.0]
+        for _, weight in candidates[1:]:
+            cost = math.log(top / max(weight, MIN_WEIGHT))
+            chunk_costs.append(max(cost, chunk_costs[-1]))
+        varying.append(i)
+        costs.append(chunk_costs)
+
+    def phrase(picks):
+        words = [candidates[0][0] for candidates in suggestions]
+        for i, pick in zip(varying, picks):
+            words[i] = suggestions[i][pick][0]
+        return u''.join(words)
+
+    # (cost, picks, pivot): a phrase is pushed once, by the one differing
+    # in its last changed chunk, which is never changed before the pivot
+    heap = [(0.0, (0,) * len(varying), 0)]
+    result = []
+    seen = set()
+    while heap and len(result) < k:
+        cost, picks, pivot = heapq.heappop(heap)
+        # a word may be a candidate twice, found by two lookups
+        text = phrase(picks)
+        if text not in seen:
+            seen.add(text)
+            result.append((text, math.exp(-cost)))
+        for j in range(pivot, len(varying)):
+            pick = picks[j] + 1
+            if pick < len(costs[j]):
+                heapq.heappush(heap, (
+                    cost - costs[j][pick - 1] + costs[j][pick],
+                    picks[:j] + (pick,) + picks[j + 1:],
+                    j))
+    return result
 
 
 def register_typo(cls):
@@ -14,3 +73,76 @@ def register_typo(cls):
                            .format(cls))
     TYPO_CLASSES[cls.typo_name] = cls
     return cls
+
+
+class LRUCache(object):
+    """
+    Bounded by the number of entries, or by the sum of weigh(value) of
+    them with weigh, counts hits and misses
+    """
+
+    def __init__(self, size, weigh=None):
+        self.size = size
+        self.weigh = weigh
+        self.entries = OrderedDict()
+        self.weights = {}
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if key in self.entries:
+            del self.entries[key]
+            self.weight -= self.weights.pop(key)
+        self.entries[key] = value
+        self.weights[key] = self.weigh(value) if self.weigh else 1
+        self.weight += self.weights[key]
+        # the entry just set stays, even if it is heavier than size
+        while self.weight > self.size and len(self.entries) > 1:
+            old, _ = self.entries.popitem(last=False)
+            self.weight -= self.weights.pop(old)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.weights.clear()
+        self.weight = 0
+
+
+class Deadline(object):
+    """
+    Time budget of a request, in seconds from start. The search checks
+    it between its steps and counts the steps it skipped once it is
+    over, a result is partial when any was.
+    """
+
+    def __init__(self, budget, start=None):
+        # time.time() rather than a monotonic clock, a deadline may be
+        # passed to a pool process
+        self.at = (time.time() if start is None else start) + budget
+        self.skipped = 0
+
+    @property
+    def partial(self):
+        return self.skipped > 0
+
+    def exceeded(self):
+        """ True when the time is over, the caller skips a step then """
+        if time.time() < self.at:
+            return False
+        self.skipped += 1
+        return True
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Named indexes hosted by one process, see the --index option of the
+servers: a request names the index it is corrected with.
+"""
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from correctors.delta import log_path
+from metrics import instrument_corrector
+
+logger = logging.getLogger(__name__)
+
+LANGS = ('ru', 'en', 'other')
+
+
+def parse_index(spec):
+    """ (name, path, lang) of NAME=PATH[:LANG], lang is None without it """
+    name, sep, path = spec.partition('=')
+    if not sep or not name or not path or ' ' in name:
+        raise ValueError('not NAME=PATH[:LANG]: {}'.format(spec))
+    lang = None
+    head, sep, tail = path.rpartition(':')
+    if sep and tail in LANGS:
+        path, lang = head, tail
+    return name, os.path.abspath(path), lang
+
+
+class Indexes(object):
+    """
+    Correctors of named indexes, made on the first use of an index.
+    An index takes the size of its file and log and the memory of its
+    engine, engine_memory (mmap pages are shared, it is the most they
+    take). When the indexes loaded take more than memory_limit (0 does
+    not limit them), the least recently used ones are dropped, they are
+    loaded again when asked for.
+
+    options are of corrector_cls, lang is the one of the index if given.
+    """
+
+    def __init__(self, specs, corrector_cls, memory_limit=0, **options):
+        self.specs = OrderedDict((name, (path, lang))
+                                 for name, path, lang in specs)
+        self.corrector_cls = corrector_cls
+        self.memory_limit = memory_limit
+        self.options = options
+        self.loaded = OrderedDict()  # name -> corrector, least recent first
+        self.sizes = {}  # name -> bytes of the loaded ones
+        self.metrics = None
+
+    def instrument(self, metrics):
+        """ Count the requests, loads and drops of every index in metrics """
+        self.metrics = metrics
+        metrics.gauge('typo_indexes_bytes', 'Bytes of the loaded indexes',
+                      function=lambda: sum(self.sizes.values()))
+        for name in self.specs:
+            metrics.gauge('typo_index_loaded', 'Is the index loaded',
+                          function=lambda name=name: int(name in self.loaded),
+                          index=name)
+        for corrector_name, corrector in self.loaded.items():
+            instrument_corrector(corrector, metrics, index=corrector_name)
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    def paths(self):
+        """ The files of the indexes, loaded or not """
+        return [path for path, lang in self.specs.values()]
+
+    def correctors(self):
+        """ The correctors of the loaded indexes """
+        return list(self.loaded.values())
+
+    def requested(self, name):
+        # a request of the index, get counts it
+        if self.metrics is not None:
+            self.metrics.counter('typo_index_requests_total',
+                                 'Requests by index', index=name).inc()
+
+    def get(self, name):
+        """ The corrector of the index, KeyError if it is not hosted """
+        if name not in self.specs:
+            raise KeyError(name)
+        self.requested(name)
+        corrector = self.loaded.pop(name, None)
+        if corrector is None:
+            corrector = self.load(name)
+        self.loaded[name] = corrector
+        self.evict()
+        return corrector
+
+    def load(self, name):
+        path, lang = self.specs[name]
+        options = dict(self.options)
+        if lang is not None:
+            options['lang'] = lang
+        start = time.time()
+        corrector = self.corrector_cls(path, **options)
+        duration = time.time() - start
+        self.sizes[name] = self.size(corrector)
+        if self.metrics is not None:
+            instrument_corrector(corrector, self.metrics, index=name)
+            self.metrics.counter('typo_index_loads_total',
+                                 'Loads of the index', index=name).inc()
+            self.metrics.histogram('typo_index_load_seconds',
+                                   'Time to load an index').observe(duration)
+        logger.info('Loaded index {} from {} in {:.3f}s'
+                    .format(name, path, duration))
+        return corrector
+
+    def size(self, corrector):
+        size = os.path.getsize(corrector.filename)
+        if os.path.exists(log_path(corrector.filename)):
+            size += os.path.getsize(log_path(corrector.filename))
+        return size + self.options.get('engine_memory', 0)
+
+    def evict(self):
+        # the index used last stays, even if it is heavier than the limit
+        while self.memory_limit and len(self.loaded) > 1 and \
+                sum(self.sizes.values()) > self.memory_limit:
+            name, _ = self.loaded.popitem(last=False)
+            del self.sizes[name]
+            if self.metrics is not None:
+                self.metrics.counter('typo_index_evictions_total',
+                                     'Drops of the index by the memory limit',
+                                     index=name).inc()
+            logger.info('Dropped index {}'.format(name))
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+In-process counters and histograms, rendered as Prometheus text or
+as a dict for the STATS command.
+"""
+import logging
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+from timeit import default_timer
+
+logger = logging.getLogger(__name__)
+
+# seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# corrector method -> stage it is timed as
+CORRECTOR_STAGES = {
+    'split_chunks': 'split_chunks',
+    'handle_glued': 'glued',
+    'handle_reverse': 'reverse',
+    'handle_deletes': 'corpus',
+    'handle_corpus': 'corpus',
+}
+
+
+class Counter(object):
+    """ A count, or the one function reads from where it is kept """
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def inc(self, value=1):
+        self.value += value
+
+    def snapshot(self):
+        return self.function() if self.function else self.value
+
+    def samples(self, name, labels):
+        yield name, labels, self.snapshot()
+
+
+class Gauge(Counter):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, value=1):
+        self.value -= value
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        # (le, observations <= le) as Prometheus has them
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield le, total
+
+    def snapshot(self):
+        return dict(count=self.count, sum=self.sum,
+                    buckets=list(self.cumulative()))
+
+    def samples(self, name, labels):
+        for le, total in self.cumulative():
+            yield name + '_bucket', labels + (('le', str(le)),), total
+        yield name + '_count', labels, self.count
+        yield name + '_sum', labels, self.sum
+
+
+class Metrics(object):
+    """ Metric families by name, every family has metrics by labels """
+    types = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+    def __init__(self):
+        self.families = OrderedDict()
+
+    def metric(self, cls, name, help, labels, **kw):
+        family = self.families.setdefault(name, (cls, help, OrderedDict()))
+        key = tuple(sorted(labels.items()))
+        if key not in family[2]:
+            family[2][key] = cls(**kw)
+        return family[2][key]
+
+    def counter(self, name, help, function=None, **labels):
+        return self.read(Counter, name, help, function, labels)
+
+    def gauge(self, name, help, function=None, **labels):
+        return self.read(Gauge, name, help, function, labels)
+
+    def read(self, cls, name, help, function, labels):
+        metric = self.metric(cls, name, help, labels, function=function)
+        # a metric registered again reads the new function
+        if function is not None:
+            metric.function = function
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self.metric(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """ Prometheus text exposition format """
+        lines = []
+        for name, (cls, help, metrics) in self.families.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, self.types[cls]))
+            for labels, metric in metrics.items():
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    if sample_labels:
+                        sample += '{{{}}}'.format(','.join(
+                            '{}="{}"'.format(k, v) for k, v in sample_labels))
+                    lines.append('{} {}'.format(sample, value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        result = {}
+        for name, (cls, help, metrics) in self.families.items():
+            for labels, metric in metrics.items():
+                key = ','.join('{}={}'.format(k, v) for k, v in labels)
+                result.setdefault(name, {})[key] = metric.snapshot()
+        return result
+
+
+def timed(method, histogram):
+    @wraps(method)
+    def wrapper(*a, **kw):
+        start = default_timer()
+        try:
+            return method(*a, **kw)
+        finally:
+            histogram.observe(default_timer() - start)
+    return wrapper
+
+
+def instrument_corrector(corrector, metrics, **labels):
+    """
+    Time the stages of a corrector and count the candidates it finds.
+    Methods are wrapped on the instance, so an uninstrumented corrector
+    does not pay for it. labels tell the metrics of correctors apart, the
+    metrics reading it do not keep a corrector alive.
+    """
+    for method, stage in CORRECTOR_STAGES.items():
+        if hasattr(corrector, method):
+            histogram = metrics.histogram(
+                'typo_stage_seconds', 'Time spent in a corrector stage',
+                stage=stage, **labels)
+            setattr(corrector, method, timed(getattr(corrector, method),
+                                             histogram))
+
+    find_candidates = corrector.find_candidates
+    duration = metrics.histogram('typo_find_candidates_seconds',
+                                 'Time to find candidates of a word',
+                                 **labels)
+    candidates = metrics.histogram('typo_candidates',
+                                   'Number of candidates found for a word',
+                                   buckets=COUNT_BUCKETS, **labels)
+
+    @wraps(find_candidates)
+    def counted(*a, **kw):
+        start = default_timer()
+        result = find_candidates(*a, **kw)
+        duration.observe(default_timer() - start)
+        candidates.observe(len(result))
+        return result
+    corrector.find_candidates = counted
+
+    ref = weakref.ref(corrector)
+
+    def reading(function):
+        # the function of the corrector, 0 once it is gone
+        def read():
+            corrector = ref()
+            return function(corrector) if corrector is not None else 0
+        return read
+
+    if hasattr(corrector, 'engine'):
+        # the engine is replaced by a reload
+        def engine_caches(corrector):
+            return corrector.engine.caches()
+        metrics.gauge('typo_engine_letters',
+                      'First letters kept by the engine',
+                      function=reading(lambda c: sum(
+                          len(cache) for cache in engine_caches(c))),
+                      **labels)
+        metrics.gauge('typo_engine_bytes',
+                      'Bytes of the first letters kept by the engine, about',
+                      function=reading(lambda c: sum(
+                          cache.weight for cache in engine_caches(c))),
+                      **labels)
+        metrics.counter('typo_engine_evictions_total',
+                        'First letters dropped by the engine',
+                        function=reading(lambda c: sum(
+                            cache.evictions for cache in engine_caches(c))),
+                        **labels)
+
+    if getattr(corrector, 'cache', None) is not None:
+        metrics.counter('typo_cache_hits_total', 'Candidate cache hits',
+                        function=reading(lambda c: c.cache.hits), **labels)
+        metrics.counter('typo_cache_misses_total', 'Candidate cache misses',
+                        function=reading(lambda c: c.cache.misses), **labels)
+        metrics.gauge('typo_cache_entries', 'Candidate cache entries',
+                      function=reading(lambda c: len(c.cache)), **labels)
+    return corrector
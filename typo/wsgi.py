@@ -1,41 +1,13 @@
 # -*- coding: utf-8 -*-
-import cgi
 import sys
-import json
-from itertools import product
 
 import click
 
+from app import make_app
 from correctors import TYPO_CLASSES
-
-
-def make_app(corrector, format, limit=10):
-    def application(env, start_response):
-        method = env['REQUEST_METHOD']
-        if method == 'GET':
-            qs = cgi.parse_qs(env['QUERY_STRING'])
-            typo = qs.get('query', [''])[0]
-        elif method == 'POST':
-            typo = env['wsgi.input'].read()
-        else:
-            start_response('405 Method Not Allowed')
-            return []
-        start_response('200 OK',
-                       [('Content-Type', 'text/plain; charset=UTF-8')])
-        typo = typo.decode('utf-8').strip()
-        suggestions, _ = corrector.suggestion(typo)
-
-        if format == 'json':
-            result = json.dumps(suggestions, ensure_ascii=False).encode('utf-8')
-        else:
-            results = []
-            for i, p in enumerate(product(*suggestions)):
-                if i > limit:
-                    break
-                results.append(u"".join(word for word, weight in p))
-            result = '\n'.join(results).encode('utf-8')
-        return [result]
-    return application
+from correctors.engines import ENGINES
+from indexes import Indexes, parse_index
+from metrics import Metrics
 
 
 @click.command()
@@ -51,15 +23,36 @@ def make_app(corrector, format, limit=10):
 @click.option('--max-candidates', type=click.INT,
               default=1)
 @click.option('--limit', type=click.INT, default=10)
+@click.option('--cache-size', type=click.IntRange(0, None), default=0)
+@click.option('--engine', type=click.Choice(sorted(ENGINES)))
+@click.option('--engine-memory', type=click.IntRange(0, None), default=0)
+@click.option('--deadline', type=click.IntRange(0, None), default=0)
+@click.option('--named-index', multiple=True)
+@click.option('--index-memory', type=click.IntRange(0, None), default=0)
 def cli(*a, **kw):
     pass
 
 
 ctx = cli.make_context('wsgi', sys.argv[1:])
 corrector_cls = TYPO_CLASSES.get(ctx.params['corrector'])
-corrector_inst = corrector_cls(ctx.params['index'],
-                               max_candidates=ctx.params['max_candidates'],
-                               lang=ctx.params['lang'])
-application = make_app(corrector_inst, ctx.params['format'], ctx.params['limit'])
+corrector_options = dict(max_candidates=ctx.params['max_candidates'],
+                         lang=ctx.params['lang'],
+                         cache_size=ctx.params['cache_size'],
+                         engine=ctx.params['engine'],
+                         engine_memory=ctx.params['engine_memory'] << 20)
+if ctx.params['named_index']:
+    # NAME=PATH[:LANG] of the indexes hosted instead of --index
+    corrector_inst = None
+    indexes = Indexes([parse_index(spec)
+                       for spec in ctx.params['named_index']],
+                      corrector_cls,
+                      memory_limit=ctx.params['index_memory'] << 20,
+                      **corrector_options)
+else:
+    corrector_inst = corrector_cls(ctx.params['index'], **corrector_options)
+    indexes = None
+application = make_app(corrector_inst, ctx.params['format'], ctx.params['limit'],
+                       metrics=Metrics(), deadline=ctx.params['deadline'],
+                       indexes=indexes)
 
 __all__ = ['application']